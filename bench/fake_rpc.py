@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+from web3._utils.abi import get_abi_input_types, get_abi_output_types
+
+from modules.providers import data_abi, eth_oracle_abi, multicall_abi, oracle_abi
+
+# A stand-in JSON-RPC node that answers eth_call for the contracts in
+# modules/providers.py after a fixed latency. Multicalls are unpacked and
+# every inner call is answered the same way. The chain makes a block every
+# block time, with 0 every eth_blockNumber sees a new block so no call is
+# answered from the server's block cache
+
+values = {
+    "getUserReserveData": [5 * 10**18, 0, 10**18, 0, 0, 0, 0, 0, True],
+    "getAssetPrice": [10**8],
+    "latestAnswer": [2000 * 10**8],
+}
+BLOCK_NUMBER = 15000000
+
+
+def selectors():
+    functions = {}
+    for abi in (data_abi, oracle_abi, eth_oracle_abi, multicall_abi):
+        for fn in abi:
+            signature = f"{fn['name']}({','.join(get_abi_input_types(fn))})"
+            functions[Web3.keccak(text=signature)[:4]] = fn
+    return functions
+
+
+class FakeRPC:
+    def __init__(self, latency, block_time):
+        self.latency = latency
+        self.block_time = block_time
+        self.started = time.monotonic()
+        self.block = BLOCK_NUMBER
+        self.functions = selectors()
+
+    def block_number(self):
+        if self.block_time == 0:
+            self.block += 1
+        else:
+            elapsed = time.monotonic() - self.started
+            self.block = BLOCK_NUMBER + int(elapsed / self.block_time)
+        return self.block
+
+    def call(self, data):
+        fn = self.functions[data[:4]]
+        if fn["name"] == "aggregate3":
+            (calls,) = decode_abi(get_abi_input_types(fn), data[4:])
+            results = []
+            for _, allow_failure, inner in calls:
+                try:
+                    results.append((True, self.call(inner)))
+                except KeyError:
+                    results.append((False, b""))
+            return encode_abi(get_abi_output_types(fn), [results])
+        return encode_abi(get_abi_output_types(fn), values[fn["name"]])
+
+    def answer(self, request):
+        if request["method"] == "eth_blockNumber":
+            return {"result": hex(self.block_number())}
+        if request["method"] != "eth_call":
+            return {"error": {"code": -32601, "message": "method not found"}}
+        data = bytes.fromhex(request["params"][0]["data"][2:])
+        return {"result": "0x" + self.call(data).hex()}
+
+    async def handle(self, request):
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        batch = body if isinstance(body, list) else [body]
+        responses = [
+            {"jsonrpc": "2.0", "id": item["id"], **self.answer(item)} for item in batch
+        ]
+        return web.json_response(responses if isinstance(body, list) else responses[0])
+
+
+def make_app(args):
+    rpc = FakeRPC(args.rpc_latency / 1000, args.block_time / 1000)
+    app = web.Application()
+    app.router.add_post("/{chain}", rpc.handle)
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument("--rpc-port", type=int, default=8102)
+    parser.add_argument("--rpc-latency", type=float, default=20, help="ms")
+    parser.add_argument("--block-time", type=float, default=0, help="ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(make_app(args), port=args.rpc_port)
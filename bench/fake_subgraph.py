@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import re
+
+from aiohttp import web
+
+# A stand-in for the Messari subgraphs that answers the queries built in
+# modules/query.py from a synthetic dataset, or replays a recorded account
+# response. Every address gets the same shape of data
+
+NESTED_PAGE_SIZE = 100
+
+activity_collections = {
+    "deposits": ("deposits", "account"),
+    "borrows": ("borrows", "account"),
+    "repays": ("repays", "account"),
+    "withdraws": ("withdraws", "account"),
+    "liquidations": ("liquidates", "liquidatee"),
+}
+sides = {
+    "LENDER": ("deposits", "withdraws"),
+    "BORROWER": ("borrows", "repays"),
+}
+
+
+class Dataset:
+    def __init__(self, events, positions, snapshots, markets):
+        self.events = events
+        self.positions = positions
+        self.snapshots = snapshots
+        self.markets = markets
+        self.accounts = {}
+        # (entity, back reference field, referenced id) -> items
+        self.collections = {}
+
+    def catalog(self):
+        return [
+            {
+                "id": f"m{i}",
+                "name": f"Market {i}",
+                "inputToken": {
+                    "id": "0x%040x" % (0x1000 + i),
+                    "name": f"Token {i}",
+                    "symbol": f"T{i}",
+                    "decimals": 18,
+                },
+                "inputTokenPriceUSD": "1.0",
+                "rates": [
+                    {"rate": "2.0", "side": "LENDER", "type": "VARIABLE"},
+                    {"rate": "3.0", "side": "BORROWER", "type": "VARIABLE"},
+                    {"rate": "4.0", "side": "BORROWER", "type": "STABLE"},
+                ],
+            }
+            for i in range(self.markets)
+        ]
+
+    def add(self, entity, field, ref, items):
+        self.collections[(entity, field, ref)] = items
+        return items
+
+    def account(self, address):
+        if address in self.accounts:
+            return self.accounts[address]
+        account = {"id": address}
+        for key, (entity, field) in activity_collections.items():
+            events = [
+                {
+                    "id": f"{address}-{key}-{i}",
+                    "hash": "0x%064x" % i,
+                    "timestamp": str(1600000000 + i * 60),
+                    "amount": str(10**18 * (1 + i % 5)),
+                    "amountUSD": str(1.0 + i % 5),
+                    "market": {"id": f"m{i % self.markets}"},
+                }
+                for i in range(self.events)
+            ]
+            account[key] = self.add(entity, field, address, events)
+        account["lend_positions"] = [
+            {
+                "market": {"id": f"m{i}"},
+                "balance": str(5 * 10**18),
+                "isCollateral": True,
+            }
+            for i in range(self.positions)
+        ]
+        account["borrow_positions"] = [
+            {
+                "market": {"id": f"m{i}"},
+                "balance": str(10**18),
+                "_variableDebtBalance": str(10**18),
+                "_stableDebtBalance": "0",
+            }
+            for i in range(self.positions)
+        ]
+        for side, (inflow, outflow) in sides.items():
+            account[side] = [
+                self.position(address, side, inflow, outflow, i)
+                for i in range(self.positions)
+            ]
+        self.accounts[address] = account
+        return account
+
+    def position(self, address, side, inflow, outflow, index):
+        position_id = f"{address}-{side}-{index}"
+        position = {
+            "id": position_id,
+            "market": {"id": f"m{index % self.markets}"},
+            "balance": str(10**18 * (1 + self.events)),
+        }
+        for key, offset, amount in ((inflow, 0, 3), (outflow, 30, 1)):
+            flows = [
+                {
+                    "id": f"{position_id}-{key}-{i}",
+                    "timestamp": str(1600000000 + i * 60 + offset),
+                    "amount": str(amount * 10**18),
+                    "amountUSD": str(float(amount)),
+                }
+                for i in range(self.events)
+            ]
+            position[key] = self.add(key, "position", position_id, flows)
+        snapshots = [
+            {
+                "id": f"{position_id}-snapshot-{i}",
+                "timestamp": str(1600000000 + i * 30),
+                "balance": str(10**18 * (i + 1)),
+            }
+            for i in range(self.snapshots)
+        ]
+        position["snapshots"] = self.add(
+            "positionSnapshots", "position", position_id, snapshots
+        )
+        return position
+
+
+def matches(item, where):
+    for key, value in where.items():
+        field, _, op = key.partition("_")
+        if field not in item:
+            continue
+        left, right = item[field], value
+        if field == "timestamp":
+            left, right = int(left), int(right)
+        if op == "" and left != right:
+            return False
+        if op == "gt" and not left > right:
+            return False
+        if op == "lt" and not left < right:
+            return False
+        if op == "gte" and not left >= right:
+            return False
+        if op == "lte" and not left <= right:
+            return False
+    return True
+
+
+def nested(items, since):
+    # Nested lists come back filtered and cut at the default page size
+    return [item for item in items if int(item["timestamp"]) > since][:NESTED_PAGE_SIZE]
+
+
+def account_fields(account):
+    return {
+        **{key: nested(account[key], 0) for key in activity_collections},
+        "lend_positions": account["lend_positions"],
+        "borrow_positions": account["borrow_positions"],
+    }
+
+
+def positions_fields(account, side, since):
+    return [
+        {
+            key: nested(value, since) if isinstance(value, list) else value
+            for key, value in position.items()
+        }
+        for position in account[side]
+    ]
+
+
+class FakeSubgraph:
+    def __init__(self, dataset, latency, replay=None):
+        self.dataset = dataset
+        self.latency = latency
+        self.replay = replay
+
+    def answer(self, query, variables):
+        if "markets(first: 1000)" in query:
+            return {"markets": self.dataset.catalog()}
+        if "items:" in query:
+            return {"items": self.page(query, variables)}
+        if "accounts(where: {id_in: $ids}" in query:
+            return {"accounts": [self.bulk_account(i) for i in variables["ids"]]}
+        if self.replay is not None:
+            return self.replay
+        account = self.dataset.account(variables["id"])
+        data = {}
+        for alias in re.findall(r"^(\w+): account\(", query, re.M) or [None]:
+            since = int(variables.get(f"{alias}_since", variables.get("since", 0)))
+            data[alias or "account"] = self.account_field(account, alias, query, since)
+        return data
+
+    def account_field(self, account, alias, query, since):
+        # Aliases name the parts of a combined query, a standalone query is
+        # told apart by the positions it selects
+        if alias == "lend_revenue" or alias is None and "side:LENDER" in query:
+            return {"positions": positions_fields(account, "LENDER", since)}
+        if alias == "borrow_cost" or alias is None and "side:BORROWER" in query:
+            return {"positions": positions_fields(account, "BORROWER", since)}
+        return account_fields(account)
+
+    def bulk_account(self, address):
+        account = self.dataset.account(address)
+        return {
+            "id": address,
+            **account_fields(account),
+            "lend_revenue_positions": positions_fields(account, "LENDER", 0),
+            "borrow_cost_positions": positions_fields(account, "BORROWER", 0),
+        }
+
+    def page(self, query, variables):
+        entity = re.search(r"items: (\w+)\(", query).group(1)
+        order_by = re.search(r"orderBy: (\w+)", query).group(1)
+        descending = "orderDirection: desc" in query
+        where = dict(variables["where"])
+        refs = [k for k in where if k in ("account", "liquidatee", "position")]
+        if len(refs) == 0:
+            return []
+        field = refs[0]
+        ref = where.pop(field)
+        if field != "position":
+            self.dataset.account(ref)
+        items = self.dataset.collections.get((entity, field, ref), [])
+        items = [item for item in items if matches(item, where)]
+        if order_by == "timestamp":
+            items.sort(key=lambda item: (int(item["timestamp"]), item["id"]))
+        else:
+            items.sort(key=lambda item: item["id"])
+        if descending:
+            items.reverse()
+        return items[: variables["first"]]
+
+    async def handle(self, request):
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        data = self.answer(body["query"], body.get("variables") or {})
+        return web.json_response({"data": data})
+
+
+def make_app(args):
+    dataset = Dataset(args.events, args.positions, args.snapshots, args.markets)
+    replay = None
+    if args.replay is not None:
+        with open(args.replay) as f:
+            replay = json.load(f)["data"]
+    subgraph = FakeSubgraph(dataset, args.subgraph_latency / 1000, replay)
+    app = web.Application()
+    app.router.add_post("/{version}/{market}", subgraph.handle)
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument("--subgraph-port", type=int, default=8101)
+    parser.add_argument("--subgraph-latency", type=float, default=100, help="ms")
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--positions", type=int, default=4)
+    parser.add_argument("--snapshots", type=int, default=100)
+    parser.add_argument("--markets", type=int, default=8)
+    parser.add_argument("--replay", help="recorded account response to serve")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(make_app(args), port=args.subgraph_port)
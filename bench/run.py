@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+import numpy as np
+
+from bench import fake_rpc, fake_subgraph
+
+# Drives /account against the local stand-ins at each concurrency level and
+# reports throughput and latency percentiles. With --baseline it fails when a
+# level is slower than the saved run by more than --tolerance
+#
+#   python -m bench.run --concurrency 1,8,32 --requests 200
+#   python -m bench.run --save bench.json
+#   python -m bench.run --baseline bench.json
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    fake_subgraph.add_arguments(parser)
+    fake_rpc.add_arguments(parser)
+    parser.add_argument("--app-port", type=int, default=8100)
+    parser.add_argument("--version", default="v2")
+    parser.add_argument("--market", default="polygon")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--requests", type=int, default=200, help="per level")
+    parser.add_argument("--addresses", type=int, default=50)
+    parser.add_argument(
+        "--cached", action="store_true", help="let requests hit the account cache"
+    )
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against a saved run")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    return parser.parse_args()
+
+
+def spawn(module, args, env=None):
+    return subprocess.Popen([sys.executable, "-m", *module, *args], env=env)
+
+
+def start_servers(args):
+    fake_args = [
+        f"--subgraph-port={args.subgraph_port}",
+        f"--subgraph-latency={args.subgraph_latency}",
+        f"--events={args.events}",
+        f"--positions={args.positions}",
+        f"--snapshots={args.snapshots}",
+        f"--markets={args.markets}",
+    ]
+    if args.replay is not None:
+        fake_args.append(f"--replay={args.replay}")
+    env = {
+        **os.environ,
+        "SUBGRAPH_URL": f"http://127.0.0.1:{args.subgraph_port}/{{version}}/{{market}}",
+        "RPC_URL": f"http://127.0.0.1:{args.rpc_port}/{{chain}}",
+        "PNL_STORE_PATH": ":memory:",
+        # Reread the block number as often as the fake chain makes blocks
+        "BLOCK_TTL": str(args.block_time / 1000),
+    }
+    return [
+        spawn(["bench.fake_subgraph"], fake_args),
+        spawn(
+            ["bench.fake_rpc"],
+            [
+                f"--rpc-port={args.rpc_port}",
+                f"--rpc-latency={args.rpc_latency}",
+                f"--block-time={args.block_time}",
+            ],
+        ),
+        spawn(
+            ["uvicorn", "main:app"],
+            [f"--port={args.app_port}", "--log-level=warning"],
+            env,
+        ),
+    ]
+
+
+async def wait_for(session, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                return
+        except aiohttp.ClientError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run_level(session, args, concurrency, requests):
+    url = f"http://127.0.0.1:{args.app_port}/account"
+    addresses = ["0x%040x" % (0xBE00 + i) for i in range(args.addresses)]
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(addresses[i % len(addresses)])
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            address = queue.get_nowait()
+            params = {"version": args.version, "market": args.market}
+            params["address"] = address
+            if not args.cached:
+                params["refresh"] = "true"
+            start = time.perf_counter()
+            async with session.get(url, params=params) as response:
+                body = await response.json()
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200 or body.get("data") is None:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+    }
+
+
+def compare(results, baseline, tolerance):
+    # A level regresses when its p95 grows or its throughput drops by more
+    # than the tolerance
+    previous = {r["concurrency"]: r for r in baseline}
+    failed = []
+    for result in results:
+        before = previous.get(result["concurrency"])
+        if before is None:
+            continue
+        if result["p95"] > before["p95"] * (1 + tolerance):
+            failed.append(
+                f"c={result['concurrency']} p95 {before['p95']:.1f}ms -> {result['p95']:.1f}ms"
+            )
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            failed.append(
+                f"c={result['concurrency']} throughput {before['throughput']:.1f}/s -> {result['throughput']:.1f}/s"
+            )
+    return failed
+
+
+async def main(args):
+    levels = [int(c) for c in args.concurrency.split(",")]
+    results = []
+    timeout = aiohttp.ClientTimeout(total=300)
+    connector = aiohttp.TCPConnector(limit=max(levels))
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await wait_for(session, f"http://127.0.0.1:{args.app_port}/stats")
+        # One untimed pass loads the market catalog and opens connections
+        await run_level(session, args, 1, 5)
+        for concurrency in levels:
+            results.append(await run_level(session, args, concurrency, args.requests))
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    processes = start_servers(args)
+    try:
+        results = asyncio.run(main(args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    print("concurrency  requests  errors  req/s     p50ms    p95ms    p99ms")
+    for r in results:
+        print(
+            f"{r['concurrency']:>11}  {r['requests']:>8}  {r['errors']:>6}  "
+            f"{r['throughput']:>8.1f}  {r['p50']:>7.1f}  {r['p95']:>7.1f}  {r['p99']:>7.1f}"
+        )
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            failed = compare(results, json.load(f), args.tolerance)
+        for line in failed:
+            print("regression:", line)
+        sys.exit(1 if len(failed) > 0 else 0)
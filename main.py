@@ -1,20 +1,34 @@
-from fastapi import FastAPI
+import os
+from typing import List
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
 from web3 import Web3
 
 
-from modules.fetcher import (
-    get_aave_data,
-    get_activity,
-    get_borrow_positions,
-    get_lend_positions,
-    get_lend_positions_for_revenue,
-    get_borrow_positions_for_cost,
-    get_borrow_cost,
-    get_lend_revenue,
+from modules.account import (
+    ACCOUNT_TIMEOUT,
+    account_cache,
+    get_cached_account,
+    stream_account,
 )
+from modules.bulk import BULK_MAX_ADDRESSES, stream_accounts
+from modules.deadline import set_deadline
+from modules.fetcher import decode_cursor, encode_cursor, get_activity_page
+from modules.http import close_sessions
+from modules.metrics import http_requests, http_responses, render
+from modules.portfolio import MARKET_TIMEOUT, get_portfolio
+from modules.providers import block_cache, warm_providers
+from modules.records import dumps
+from modules.subgraph import PAGE_SIZE
+from modules.timing import profile_summary, start_profiler, start_trace, stop_profiler
+from modules import warmup
 
-app = FastAPI()
+# Payload endpoints return ORJSONResponse directly, which skips FastAPI's
+# jsonable_encoder pass over the records
+app = FastAPI(default_response_class=ORJSONResponse)
 origins = ["*"]
 
 app.add_middleware(
@@ -26,49 +40,167 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    # Streaming responses are timed up to their first byte. Unknown paths
+    # share one label so scans cannot grow the series without bound
+    path = request.url.path
+    if path not in {route.path for route in app.routes}:
+        path = "unmatched"
+    with http_requests.track(request.method, path):
+        response = await call_next(request)
+    http_responses.inc(request.method, path, response.status_code)
+    return response
+
+
+@app.on_event("startup")
+async def startup():
+    # Startup runs in each worker after gunicorn forks
+    if os.environ.get("PROVIDERS_WARMUP") == "1":
+        warm_providers()
+    warmup.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await warmup.stop()
+    await close_sessions()
+
+
+def trim_activity(data, activity_limit):
+    # Trim a copy, the cached payload keeps the full history
+    activity = data["activity"]
+    data = {**data, "activity": activity[:activity_limit]}
+    data["activity_cursor"] = None
+    if 0 < activity_limit < len(activity):
+        data["activity_cursor"] = encode_cursor(activity[activity_limit - 1])
+    return data
+
+
+async def stream_sections(sections, stream, activity_limit):
+    try:
+        async for name, value in sections:
+            items = {name: value}
+            if name == "activity" and activity_limit is not None:
+                items = trim_activity(items, activity_limit)
+            for name, value in items.items():
+                if stream == "sse":
+                    yield b"event: %s\ndata: %s\n\n" % (name.encode(), dumps(value))
+                else:
+                    yield dumps({"section": name, "data": value}) + b"\n"
+    except Exception as e:
+        if stream == "sse":
+            yield b"event: error\ndata: %s\n\n" % dumps(str(e))
+        else:
+            yield dumps({"error": str(e)}) + b"\n"
+
+
+stream_media_types = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+
 @app.get("/account")
-def get_account(version, market, address):
+async def get_account(
+    version,
+    market,
+    address,
+    refresh: bool = False,
+    activity_limit: int = None,
+    stream: str = None,
+    profile: int = 0,
+    timeout: float = ACCOUNT_TIMEOUT,
+):
     if not Web3.isAddress(address):
         return {"error": "invalid address"}
+    if activity_limit is not None and activity_limit < 0:
+        return {"error": "activity_limit must not be negative"}
+
+    set_deadline(min(max(timeout, 0), ACCOUNT_TIMEOUT))
+
+    if stream is not None:
+        if stream not in stream_media_types:
+            return {"error": "stream must be ndjson or sse"}
+        sections = stream_account(address, version, market, refresh)
+        return StreamingResponse(
+            stream_sections(sections, stream, activity_limit),
+            media_type=stream_media_types[stream],
+        )
+
+    # profile=1 adds the span tree to the payload, profile=2 also a cProfile
+    # summary of the build
+    trace = start_trace()
+    profiler = start_profiler() if profile > 1 else None
+    try:
+        result = await get_cached_account(address, version, market, refresh)
+    finally:
+        stop_profiler(profiler)
+    data = result["data"]
+    if activity_limit is not None and data is not None and data["activity"] is not None:
+        result = {**result, "data": trim_activity(data, activity_limit)}
+    if profile > 0:
+        result = {**result, "profile": {"spans": trace.tree()}}
+        if profiler is not None:
+            result["profile"]["cprofile"] = profile_summary(profiler)
+    # The dashboard is cross-origin, browsers hide Server-Timing without TAO
+    headers = {"Server-Timing": trace.header(), "Timing-Allow-Origin": "*"}
+    return ORJSONResponse(result, headers=headers)
+
 
-    data = get_aave_data(address, version, market)
-
-    if data == None:
-        return {"data": None}
-    (
-        deposits,
-        borrows,
-        repays,
-        withdrawals,
-        liquidations,
-        lend_pos,
-        borrow_pos,
-    ) = data.values()
-
-    activity = get_activity((deposits, borrows, repays, withdrawals, liquidations))
-    lend_positions = get_lend_positions(lend_pos)
-    borrow_positions = get_borrow_positions(borrow_pos, address, version, market)
-
-    lend_revenue = 0
-    lend_positions_for_revenue = get_lend_positions_for_revenue(
-        address, version, market
+@app.get("/account/activity")
+async def get_account_activity(
+    version, market, address, limit: int = 50, cursor: str = None
+):
+    if not Web3.isAddress(address):
+        return {"error": "invalid address"}
+    if not 0 < limit <= PAGE_SIZE:
+        return {"error": f"limit must be between 1 and {PAGE_SIZE}"}
+    if cursor is not None and decode_cursor(cursor) is None:
+        return {"error": "invalid cursor"}
+
+    data = await get_activity_page(address, version, market, limit, cursor)
+    return ORJSONResponse({"data": data})
+
+
+@app.get("/portfolio")
+async def get_account_portfolio(address, timeout: float = MARKET_TIMEOUT):
+    if not Web3.isAddress(address):
+        return {"error": "invalid address"}
+
+    timeout = min(max(timeout, 0), MARKET_TIMEOUT)
+    return ORJSONResponse({"data": await get_portfolio(address, timeout)})
+
+
+class AccountsRequest(BaseModel):
+    version: str
+    market: str
+    addresses: List[str]
+
+
+@app.post("/accounts")
+async def get_accounts(request: AccountsRequest):
+    addresses = list(dict.fromkeys(request.addresses))
+    if len(addresses) > BULK_MAX_ADDRESSES:
+        return {"error": f"at most {BULK_MAX_ADDRESSES} addresses per request"}
+    invalid = [address for address in addresses if not Web3.isAddress(address)]
+    if len(invalid) > 0:
+        return {"error": "invalid address", "addresses": invalid}
+
+    return StreamingResponse(
+        stream_accounts(addresses, request.version, request.market),
+        media_type="application/x-ndjson",
     )
-    for lend in lend_positions_for_revenue:
-        revenue = get_lend_revenue(address, lend, version, market)
-        lend_revenue += revenue
 
-    borrow_cost = 0
-    borrow_positions_for_cost = get_borrow_positions_for_cost(address, version, market)
-    for borrow in borrow_positions_for_cost:
-        cost = get_borrow_cost(address, borrow, version, market)
-        borrow_cost += cost
 
+@app.get("/stats")
+def get_stats():
     return {
-        "data": {
-            "activity": activity,
-            "lend_positions": lend_positions,
-            "borrow_positions": borrow_positions,
-            "lend_revenue": lend_revenue,
-            "borrow_cost": borrow_cost,
-        }
+        "account_cache": account_cache.stats(),
+        "block_cache": block_cache.stats(),
     }
+
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(
+        render({"account": account_cache, "block": block_cache}),
+        media_type="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,327 @@
+import asyncio
+import os
+
+from modules.cache import ResponseCache
+from modules.deadline import (
+    DeadlineExceeded,
+    bounded,
+    clear_deadline,
+    expired,
+    remaining,
+)
+from modules.fetcher import (
+    complete_account_response,
+    complete_position_responses,
+    fetch_account_data,
+    get_account_data,
+    get_activity,
+    get_borrow_positions,
+    get_lend_positions,
+    get_onchain_data,
+    get_position_assets,
+    get_borrow_costs,
+    get_lend_revenues,
+    parse_aave_data,
+    parse_positions,
+)
+from modules.singleflight import SingleFlight
+from modules.store import in_store_thread, load_checkpoints, save_checkpoints
+from modules.timing import span, timed
+
+# /account payloads keyed by (version, market, lowercased address)
+account_cache = ResponseCache(
+    int(os.environ.get("ACCOUNT_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    float(os.environ.get("ACCOUNT_CACHE_TTL", 10)),
+    float(os.environ.get("ACCOUNT_CACHE_STALE_TTL", 60)),
+)
+refreshing = {}  # key -> background refresh task
+
+# Seconds an /account request may wait, clients can ask for less. Sections
+# that miss the deadline come back null and listed in "missing", and such
+# partial payloads are not cached. Shared builds run under their own
+# ACCOUNT_BUILD_TIMEOUT, so one impatient client cannot blank an account for
+# the others, and a build that outlives its caller still fills the cache
+ACCOUNT_TIMEOUT = float(os.environ.get("ACCOUNT_TIMEOUT", 10))
+ACCOUNT_BUILD_TIMEOUT = float(os.environ.get("ACCOUNT_BUILD_TIMEOUT", 60))
+account_flight = SingleFlight(ACCOUNT_BUILD_TIMEOUT)
+SECTIONS = [
+    "activity",
+    "lend_positions",
+    "borrow_positions",
+    "lend_revenue",
+    "borrow_cost",
+]
+
+
+sides = {"lend_revenue": "LENDER", "borrow_cost": "BORROWER"}
+
+
+async def load_all_checkpoints(address, version, market):
+    return {
+        name: await in_store_thread(load_checkpoints, market, version, address, side)
+        for name, side in sides.items()
+    }
+
+
+def get_account_assets(responses, version):
+    assets = get_position_assets(
+        parse_positions(responses["lend_revenue"])
+        + parse_positions(responses["borrow_cost"])
+    )
+    if version == "v2":
+        assets += get_position_assets(
+            parse_aave_data(responses[version])["borrow_positions"]
+        )
+    return assets
+
+
+def partial_account(sections):
+    result = {"data": {name: sections.get(name) for name in SECTIONS}}
+    missing = [name for name in SECTIONS if name not in sections]
+    if len(missing) > 0:
+        result["missing"] = missing
+    return result
+
+
+async def build_account(address, version, market):
+    checkpoints = await load_all_checkpoints(address, version, market)
+    try:
+        with span("account_data"):
+            responses = await get_account_data(address, version, market, checkpoints)
+    except DeadlineExceeded:
+        return partial_account({})
+    data = parse_aave_data(responses[version])
+    if data is None:
+        return {"data": None}
+
+    # Every on-chain read for this account goes into one multicall
+    assets = get_account_assets(responses, version)
+    try:
+        with span("onchain"):
+            onchain = await get_onchain_data(address, assets, version, market)
+    except DeadlineExceeded:
+        return partial_account(parse_sections(data))
+    return await assemble_account(
+        responses, address, version, market, onchain, checkpoints
+    )
+
+
+def parse_sections(data):
+    (
+        deposits,
+        borrows,
+        repays,
+        withdrawals,
+        liquidations,
+        lend_pos,
+        borrow_pos,
+    ) = data.values()
+    sections = {}
+    with span("compute.activity"):
+        sections["activity"] = get_activity(
+            (deposits, borrows, repays, withdrawals, liquidations)
+        )
+    with span("compute.lend_positions"):
+        sections["lend_positions"] = get_lend_positions(lend_pos)
+    return sections
+
+
+def onchain_sections(data, responses, address, version, market, onchain, checkpoints):
+    # Sections that need on-chain reads, as name -> coroutine
+    async def lend_revenue():
+        result = await get_lend_revenues(
+            address,
+            parse_positions(responses["lend_revenue"]),
+            version,
+            market,
+            onchain,
+            checkpoints.get("lend_revenue"),
+        )
+        await in_store_thread(
+            save_checkpoints, market, version, address, "LENDER", result["checkpoints"]
+        )
+        return result["total"]
+
+    async def borrow_cost():
+        result = await get_borrow_costs(
+            address,
+            parse_positions(responses["borrow_cost"]),
+            version,
+            market,
+            onchain,
+            checkpoints.get("borrow_cost"),
+        )
+        await in_store_thread(
+            save_checkpoints,
+            market,
+            version,
+            address,
+            "BORROWER",
+            result["checkpoints"],
+        )
+        return result["total"]
+
+    return {
+        "borrow_positions": timed(
+            "compute.borrow_positions",
+            get_borrow_positions(
+                data["borrow_positions"], address, version, market, onchain
+            ),
+        ),
+        "lend_revenue": timed("compute.lend_revenue", lend_revenue()),
+        "borrow_cost": timed("compute.borrow_cost", borrow_cost()),
+    }
+
+
+async def assemble_account(responses, address, version, market, onchain, checkpoints):
+    data = parse_aave_data(responses[version])
+
+    if data == None:
+        return {"data": None}
+
+    sections = parse_sections(data)
+    pending = onchain_sections(
+        data, responses, address, version, market, onchain, checkpoints
+    )
+    sections.update(await gather_sections(pending))
+    return partial_account(sections)
+
+
+async def gather_sections(pending):
+    # Sections still running at the deadline are cancelled and left out
+    tasks = {name: asyncio.ensure_future(coro) for name, coro in pending.items()}
+    try:
+        await asyncio.wait(tasks.values(), timeout=remaining())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    sections = {}
+    for name, task in tasks.items():
+        if not task.done() or isinstance(task.exception(), DeadlineExceeded):
+            continue
+        sections[name] = task.result()
+    return sections
+
+
+async def stream_account(address, version, market, refresh=False):
+    # Yields (section, value) pairs as soon as each one is computed
+    key = (version, market, address.lower())
+    if not refresh:
+        result, state = account_cache.get(key)
+        if state == "stale":
+            refresh_in_background(address, version, market)
+        if state is not None:
+            for section in (result["data"] or {"account": None}).items():
+                yield section
+            return
+
+    # Sections that miss the deadline are listed in a last "missing" section
+    checkpoints = await load_all_checkpoints(address, version, market)
+    try:
+        responses = await fetch_account_data(address, version, market, checkpoints)
+    except DeadlineExceeded:
+        yield "missing", SECTIONS
+        return
+    data = parse_aave_data(responses[version])
+    if data is None:
+        account_cache.set(key, {"data": None})
+        yield "account", None
+        return
+
+    # activity and lend_positions only need the account's own lists, the
+    # position histories are paged in meanwhile
+    positions = asyncio.ensure_future(
+        complete_position_responses(responses, version, market, checkpoints)
+    )
+    sections = {}
+    try:
+        await complete_account_response(responses, address, version, market)
+        sections = parse_sections(data)
+        for section in sections.items():
+            yield section
+        await bounded(positions)
+        assets = get_account_assets(responses, version)
+        onchain = await get_onchain_data(address, assets, version, market)
+    except DeadlineExceeded:
+        yield "missing", [name for name in SECTIONS if name not in sections]
+        return
+    finally:
+        positions.cancel()
+    pending = onchain_sections(
+        data, responses, address, version, market, onchain, checkpoints
+    )
+
+    async def named(name, coro):
+        return name, await coro
+
+    tasks = [asyncio.ensure_future(named(*item)) for item in pending.items()]
+    try:
+        for future in asyncio.as_completed(tasks, timeout=remaining()):
+            name, value = await future
+            sections[name] = value
+            yield name, value
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        if not expired():
+            raise
+    finally:
+        for task in tasks:
+            task.cancel()
+    missing = [name for name in pending if name not in sections]
+    if len(missing) > 0:
+        yield "missing", missing
+        return
+
+    # Keep the usual section order in the cached payload
+    order = ["activity", "lend_positions", *pending]
+    account_cache.set(key, {"data": {name: sections[name] for name in order}})
+
+
+async def refresh_account(address, version, market):
+    key = (version, market, address.lower())
+    try:
+        return await bounded(
+            account_flight.do(key, build_and_store, address, version, market)
+        )
+    except DeadlineExceeded:
+        return partial_account({})
+
+
+async def build_and_store(address, version, market):
+    key = (version, market, address.lower())
+    result = await build_account(address, version, market)
+    if "missing" not in result:
+        account_cache.set(key, result)
+    return result
+
+
+def refresh_in_background(address, version, market):
+    key = (version, market, address.lower())
+    if key in refreshing:
+        return
+
+    def done(task):
+        refreshing.pop(key, None)
+        # A failed refresh leaves the stale payload in place until it expires
+        if not task.cancelled():
+            task.exception()
+
+    async def refresh():
+        # The refresh outlives the request that found the stale payload
+        clear_deadline()
+        return await refresh_account(address, version, market)
+
+    task = asyncio.create_task(refresh())
+    refreshing[key] = task
+    task.add_done_callback(done)
+
+
+async def get_cached_account(address, version, market, refresh=False):
+    key = (version, market, address.lower())
+    if not refresh:
+        result, state = account_cache.get(key)
+        if state == "fresh":
+            return result
+        if state == "stale":
+            refresh_in_background(address, version, market)
+            return result
+    return await refresh_account(address, version, market)
@@ -0,0 +1,70 @@
+import asyncio
+import os
+
+from modules.account import account_cache, assemble_account, get_account_assets
+from modules.fetcher import get_accounts_data, get_onchain_pairs, parse_aave_data
+from modules.records import dumps
+
+# Addresses per accounts(id_in) query, and how many of those groups may be
+# in flight across all bulk requests of this worker
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 50))
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", 4))
+BULK_MAX_ADDRESSES = int(os.environ.get("BULK_MAX_ADDRESSES", 10000))
+
+bulk_semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+
+async def build_accounts(addresses, version, market):
+    async with bulk_semaphore:
+        responses = await get_accounts_data(addresses, version, market)
+
+        # One multicall (split into chunks if large) for the whole group
+        found = {
+            address: r
+            for address, r in responses.items()
+            if parse_aave_data(r[version]) is not None
+        }
+        pairs = [
+            (asset, address)
+            for address, r in found.items()
+            for asset in get_account_assets(r, version)
+        ]
+        onchain = await get_onchain_pairs(pairs, version, market)
+
+        built = await asyncio.gather(
+            *(
+                assemble_account(r, address, version, market, onchain, {})
+                for address, r in found.items()
+            )
+        )
+
+    built = dict(zip(found, built))
+    results = [built.get(address, {"data": None}) for address in addresses]
+    for address, result in zip(addresses, results):
+        account_cache.set((version, market, address.lower()), result)
+    return [
+        {"address": address, **result} for address, result in zip(addresses, results)
+    ]
+
+
+async def build_group(addresses, version, market):
+    try:
+        return await build_accounts(addresses, version, market)
+    except Exception as e:
+        return [{"address": address, "error": str(e)} for address in addresses]
+
+
+async def stream_accounts(addresses, version, market):
+    # Yields one NDJSON line per address, group by group as they finish
+    groups = [
+        addresses[i : i + BULK_BATCH_SIZE]
+        for i in range(0, len(addresses), BULK_BATCH_SIZE)
+    ]
+    tasks = [asyncio.ensure_future(build_group(g, version, market)) for g in groups]
+    try:
+        for future in asyncio.as_completed(tasks):
+            for line in await future:
+                yield dumps(line) + b"\n"
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,106 @@
+import time
+from collections import OrderedDict
+
+from modules.records import dumps
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value), oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.data[key] = (time.monotonic() + ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def evict(self, predicate):
+        for key in [key for key in self.data if predicate(key)]:
+            del self.data[key]
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+        }
+
+
+class ResponseCache:
+    # LRU bounded by the approximate JSON size of the stored payloads. Entries
+    # are fresh for `ttl` seconds, then stale (still served) for `stale_ttl`
+    def __init__(self, maxbytes, ttl, stale_ttl):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.data = OrderedDict()  # key -> (stored_at, size, value)
+        self.nbytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is not None:
+            age = time.monotonic() - item[0]
+            if age < self.ttl:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return item[2], "fresh"
+            if age < self.ttl + self.stale_ttl:
+                self.data.move_to_end(key)
+                self.stale_hits += 1
+                return item[2], "stale"
+            self.delete(key)
+        self.misses += 1
+        return None, None
+
+    def set(self, key, value):
+        size = len(dumps(value))
+        if size > self.maxbytes:
+            return
+        self.delete(key)
+        self.data[key] = (time.monotonic(), size, value)
+        self.nbytes += size
+        while self.nbytes > self.maxbytes:
+            _, (_, evicted, _) = self.data.popitem(last=False)
+            self.nbytes -= evicted
+
+    def delete(self, key):
+        item = self.data.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "size": len(self.data),
+            "bytes": self.nbytes,
+            "maxbytes": self.maxbytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0,
+        }
@@ -0,0 +1,63 @@
+import asyncio
+import time
+from contextvars import ContextVar
+
+# Per-request time budget. Upstream calls made for a request with a deadline
+# stop waiting once it runs out and raise DeadlineExceeded, elsewhere there
+# is no deadline
+
+deadline_var = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    # A mutable deadline, so a shared task can be given more time when a
+    # caller with a later deadline joins it. at is None for no deadline
+    __slots__ = ("at",)
+
+    def __init__(self, at=None):
+        self.at = at
+
+    def remaining(self):
+        if self.at is None:
+            return None
+        return max(0, self.at - time.monotonic())
+
+    def extend(self, other):
+        if self.at is None:
+            return
+        if other is None or other.at is None:
+            self.at = None
+        else:
+            self.at = max(self.at, other.at)
+
+
+def set_deadline(seconds):
+    deadline_var.set(Deadline(time.monotonic() + seconds))
+
+
+def clear_deadline():
+    deadline_var.set(None)
+
+
+def remaining():
+    deadline = deadline_var.get()
+    if deadline is None:
+        return None
+    return deadline.remaining()
+
+
+def expired():
+    return remaining() == 0
+
+
+async def bounded(awaitable):
+    try:
+        return await asyncio.wait_for(awaitable, remaining())
+    except asyncio.TimeoutError:
+        if expired():
+            raise DeadlineExceeded() from None
+        raise
@@ -1,59 +1,397 @@
+import asyncio
+import heapq
+
 import numpy as np
-import requests
 
-from modules.query import queries
+from modules.query import (
+    account_queries,
+    bulk_queries,
+    event_fields,
+    flow_fields,
+    snapshot_fields,
+)
+from modules.markets import get_market_catalog
+from modules.pnl import realized_pnl
 from modules.providers import providers
+from modules.records import Activity, BorrowPosition, LendPosition
+from modules.subgraph import (
+    SubgraphError,
+    fetch_all,
+    paginate_after,
+    request_subgraph,
+)
+
+# Nested lists come back with the subgraph's default page size. Any list
+# that fills a page is fetched again in full from its top-level collection
+NESTED_PAGE_SIZE = 100
+
+# account field -> (collection, field pointing back at the account)
+activity_lists = {
+    "deposits": ("deposits", "account"),
+    "borrows": ("borrows", "account"),
+    "repays": ("repays", "account"),
+    "withdraws": ("withdraws", "account"),
+    "liquidations": ("liquidates", "liquidatee"),
+}
+
+# position field -> (collection, selected fields)
+position_lists = {
+    "deposits": ("deposits", flow_fields),
+    "withdraws": ("withdraws", flow_fields),
+    "borrows": ("borrows", flow_fields),
+    "repays": ("repays", flow_fields),
+    "snapshots": ("positionSnapshots", snapshot_fields),
+}
 
 
 def to_readable(value, decimals) -> float:
     return float(value) / 10 ** int(decimals)
 
 
-def get_user_reserve_data():
-    return
+def split_response(data, names):
+    # Give each aliased field the shape of its standalone query response
+    if "errors" in data:
+        return {name: data for name in names}
+    return {name: {"data": {"account": data["data"][name]}} for name in names}
+
+
+async def fill_truncated(lists, version, market, force=False):
+    # lists holds (container, key, collection, fields, where) for each nested
+    # list, the truncated ones (or all with force) are fetched concurrently
+    # and replaced in place
+    truncated = [x for x in lists if force or len(x[0][x[1]]) >= NESTED_PAGE_SIZE]
+    results = await asyncio.gather(
+        *(
+            fetch_all(collection, fields, where, version, market)
+            for _, _, collection, fields, where in truncated
+        )
+    )
+    for (container, key, *_), items in zip(truncated, results):
+        container[key] = items
+
+
+async def complete_account(account, address, version, market):
+    if account is None:
+        return
+    lists = [
+        (account, key, collection, event_fields, {field: address.lower()})
+        for key, (collection, field) in activity_lists.items()
+    ]
+    await fill_truncated(lists, version, market)
+
+
+async def complete_positions(positions, version, market, since=0, checkpoints=None):
+    # Nested lists only hold events after `since`. A position without a
+    # checkpoint of its own has its full history fetched instead
+    checkpoints = checkpoints or {}
+    lists, missing = [], []
+    for position in positions:
+        full = since > 0 and position["id"] not in checkpoints
+        where = {"position": position["id"]}
+        if since > 0 and not full:
+            where["timestamp_gt"] = str(since)
+        for key, (collection, fields) in position_lists.items():
+            if key in position:
+                item = (position, key, collection, fields, where)
+                (missing if full else lists).append(item)
+    await asyncio.gather(
+        fill_truncated(lists, version, market),
+        fill_truncated(missing, version, market, force=True),
+    )
+
+
+def get_since(checkpoints):
+    return min((cp["timestamp"] for cp in checkpoints.values()), default=0)
+
+
+async def complete_account_response(responses, address, version, market):
+    account = parse_aave_data(responses[version])
+    await complete_account(account, address, version, market)
+    await join_markets(account, [], version, market)
+
+
+async def complete_position_responses(responses, version, market, checkpoints=None):
+    # checkpoints maps "lend_revenue"/"borrow_cost" to the stored PnL
+    # checkpoints of that side, the responses only hold newer events for those
+    checkpoints = checkpoints or {}
+    names = ("lend_revenue", "borrow_cost")
+    await asyncio.gather(
+        *(
+            complete_positions(
+                parse_positions(responses[name]),
+                version,
+                market,
+                get_since(checkpoints.get(name, {})),
+                checkpoints.get(name),
+            )
+            for name in names
+        )
+    )
+    positions = [p for name in names for p in parse_positions(responses[name])]
+    await join_markets(None, positions, version, market)
+
+
+async def complete_responses(responses, address, version, market, checkpoints=None):
+    await asyncio.gather(
+        complete_account_response(responses, address, version, market),
+        complete_position_responses(responses, version, market, checkpoints),
+    )
+
+
+def join_events(events, catalog):
+    for event in events:
+        market = catalog[event["market"]["id"]]
+        event["market"] = market
+        event["asset"] = market["inputToken"]
+
+
+def join_positions(positions, catalog):
+    for position in positions:
+        position["market"] = catalog[position["market"]["id"]]
+
+
+async def join_markets(account, positions, version, market):
+    # Replaces the bare market ids selected by the account queries with the
+    # shared catalog entries, and gives events their market's input token
+    events = []
+    if account is not None:
+        events = [event for key in activity_lists for event in account[key]]
+        positions = positions + account["lend_positions"] + account["borrow_positions"]
+    ids = {item["market"]["id"] for item in events + positions}
+    catalog = await get_market_catalog(version, market, ids)
+    join_events(events, catalog)
+    join_positions(positions, catalog)
+
+
+async def fetch_account_data(address, version, market, checkpoints=None):
+    # The account query alone, its nested lists may still be truncated and
+    # hold bare market ids
+    checkpoints = checkpoints or {}
+    names = (version, "lend_revenue", "borrow_cost")
+    variables = {"id": address.lower()}
+    for name in names[1:]:
+        variables[f"{name}_since"] = str(get_since(checkpoints.get(name, {})))
+
+    # The catalog is only fetched here when this worker has none yet
+    data, _ = await asyncio.gather(
+        request_subgraph(account_queries[version], variables, version, market, version),
+        get_market_catalog(version, market),
+    )
+    # A failed query must not look like an address without an account
+    if "errors" in data:
+        raise SubgraphError(data["errors"])
+    return split_response(data, names)
+
 
+async def get_account_data(address, version, market, checkpoints=None):
+    responses = await fetch_account_data(address, version, market, checkpoints)
+    await complete_responses(responses, address, version, market, checkpoints)
+    return responses
+
+
+async def get_accounts_data(addresses, version, market):
+    # One accounts(id_in) query for a group of addresses, split per address
+    # into the same shape get_account_data returns
+    ids = [address.lower() for address in addresses]
+    data, _ = await asyncio.gather(
+        request_subgraph(
+            bulk_queries[version], {"ids": ids}, version, market, "accounts"
+        ),
+        get_market_catalog(version, market),
+    )
+    if "errors" in data:
+        raise SubgraphError(data["errors"])
+
+    accounts = {account["id"]: account for account in data["data"]["accounts"]}
+    results = {}
+    for address in addresses:
+        account = accounts.get(address.lower())
+        if account is None:
+            results[address] = split_response({"data": {version: None}}, (version,))
+            continue
+        account = dict(account)
+        del account["id"]
+        lend = account.pop("lend_revenue_positions")
+        borrow = account.pop("borrow_cost_positions")
+        results[address] = {
+            version: {"data": {"account": account}},
+            "lend_revenue": {"data": {"account": {"positions": lend}}},
+            "borrow_cost": {"data": {"account": {"positions": borrow}}},
+        }
 
-def get_aave_data(address, version, market):
-    params = {"id": address.lower()}
-    response = requests.post(
-        f"https://api.thegraph.com/subgraphs/name/messari/aave-{version}-{market}",
-        json={"query": queries[version], "variables": params},
+    await asyncio.gather(
+        *(
+            complete_responses(responses, address, version, market)
+            for address, responses in results.items()
+            if parse_aave_data(responses[version]) is not None
+        )
     )
-    data = response.json()
+    return results
+
+
+def parse_aave_data(data):
     if "errors" in data:
-        return {"data": {"account": None}}
+        return None
     return data["data"]["account"]
 
 
+def parse_positions(data):
+    if "errors" in data or data["data"]["account"] is None:
+        return []
+    return data["data"]["account"]["positions"]
+
+
+def get_position_assets(positions):
+    return [position["market"]["inputToken"]["id"] for position in positions]
+
+
+async def get_onchain_data(address, assets, version, blockchain):
+    pairs = [(asset, address) for asset in assets]
+    return await get_onchain_pairs(pairs, version, blockchain)
+
+
+async def get_onchain_pairs(pairs, version, blockchain):
+    if len(pairs) == 0:
+        return {"reserves": {}, "prices": {}}
+    provider = providers[version][blockchain]
+    return await provider.get_reserves_and_prices(pairs)
+
+
+def get_reserve(onchain, asset, address):
+    return onchain["reserves"].get((asset.lower(), address.lower()))
+
+
+event_types = ["deposit", "borrow", "repay", "withdraw", "liquidation"]
+
+
+def to_activity(event, activity_type):
+    asset = event["asset"]
+    name = asset["name"]
+    symbol = asset["symbol"]
+    decimals = asset["decimals"]
+    amount_raw = event["amount"]
+    amount = to_readable(amount_raw, decimals)
+
+    return Activity(
+        id=event["id"],
+        timestamp=event["timestamp"],
+        txhash=event["hash"],
+        action=activity_type,
+        name=name,
+        symbol=symbol,
+        amount=amount,
+        value=float(event["amountUSD"]),
+    )
+
+
+def activity_key(activity):
+    return int(activity.timestamp), activity.id
+
+
 def get_activity(event_groups):
     activity = []
-    event_types = ["deposit", "borrow", "repay", "withdraw", "liquidation"]
     for i, events in enumerate(event_groups):
         activity_type = event_types[i]
         for event in events:
-            asset = event["asset"]
-            name = asset["name"]
-            symbol = asset["symbol"]
-            decimals = asset["decimals"]
-            amount_raw = event["amount"]
-            amount = to_readable(amount_raw, decimals)
-
-            data = {
-                "timestamp": event["timestamp"],
-                "txhash": event["hash"],
-                "action": activity_type,
-                "name": name,
-                "symbol": symbol,
-                "amount": amount,
-                "value": float(event["amountUSD"]),
-            }
-            activity.append(data)
+            activity.append(to_activity(event, activity_type))
 
-    activity.sort(key=lambda x: x["timestamp"], reverse=True)
+    activity.sort(key=activity_key, reverse=True)
 
     return activity
 
 
+def encode_cursor(activity):
+    return f"{activity.timestamp}:{activity.id}"
+
+
+def decode_cursor(cursor):
+    # None unless the cursor has the timestamp:id form encode_cursor gives
+    timestamp, _, last_id = cursor.partition(":")
+    if not (timestamp.isascii() and timestamp.isdigit()) or last_id == "":
+        return None
+    return timestamp, last_id
+
+
+class Descending:
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+async def merge_descending(streams, key):
+    # Lazy k-way merge of async iterators that each yield in descending key
+    # order. Only one item per stream is held beyond what the streams buffer
+    heap = []
+
+    async def pull(i):
+        try:
+            item = await streams[i].__anext__()
+        except StopAsyncIteration:
+            return
+        heapq.heappush(heap, (Descending(key(item)), i, item))
+
+    await asyncio.gather(*(pull(i) for i in range(len(streams))))
+    while len(heap) > 0:
+        _, i, item = heapq.heappop(heap)
+        yield item
+        await pull(i)
+
+
+async def activity_stream(
+    collection, field, activity_type, address, cursor, limit, version, market
+):
+    pages = paginate_after(
+        collection,
+        event_fields,
+        {field: address.lower()},
+        cursor,
+        version,
+        market,
+        descending=True,
+        first=limit,
+    )
+    async for page in pages:
+        ids = {event["market"]["id"] for event in page}
+        join_events(page, await get_market_catalog(version, market, ids))
+        for event in page:
+            yield to_activity(event, activity_type)
+
+
+async def get_activity_page(address, version, market, limit, cursor=None):
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+    streams = [
+        activity_stream(
+            collection, field, activity_type, address, cursor, limit, version, market
+        )
+        for (collection, field), activity_type in zip(
+            activity_lists.values(), event_types
+        )
+    ]
+
+    activity = []
+    merged = merge_descending(streams, activity_key)
+    async for item in merged:
+        activity.append(item)
+        if len(activity) == limit:
+            break
+    await merged.aclose()
+    for stream in streams:
+        await stream.aclose()
+
+    next_cursor = None
+    if len(activity) == limit:
+        next_cursor = encode_cursor(activity[-1])
+    return {"activity": activity, "next_cursor": next_cursor}
+
+
 def get_lend_positions(lend_positions):
     positions = []
 
@@ -77,14 +415,14 @@ def get_lend_positions(lend_positions):
         amount = to_readable(amount_raw, decimals)
         value = amount * float(price)
 
-        lend = {
-            "name": name,
-            "symbol": symbol,
-            "amount": amount,
-            "value": value,
-            "apy": apy,
-            "is_collateral": position["isCollateral"],
-        }
+        lend = LendPosition(
+            name=name,
+            symbol=symbol,
+            amount=amount,
+            value=value,
+            apy=apy,
+            is_collateral=position["isCollateral"],
+        )
 
         total_balance += value
         apys.append(apy)
@@ -104,13 +442,19 @@ def get_lend_positions(lend_positions):
     return data
 
 
-def get_borrow_positions(borrow_positions, address, version, blockchain):
+async def get_borrow_positions(
+    borrow_positions, address, version, blockchain, onchain=None
+):
     positions = []
 
     total_balance = 0
     apys = []
     weights = []
 
+    if version == "v2" and onchain is None:
+        assets = get_position_assets(borrow_positions)
+        onchain = await get_onchain_data(address, assets, version, blockchain)
+
     for position in borrow_positions:
         market = position["market"]
         token = market["inputToken"]
@@ -121,10 +465,8 @@ def get_borrow_positions(borrow_positions, address, version, blockchain):
 
         rates = [rate for rate in market["rates"] if rate["side"] == "BORROWER"]
         if version == "v2":
-            token_address = token["id"]
-            variable_debt = providers[version][blockchain].get_user_reserve_data(
-                token_address, address
-            )[2]
+            reserve = get_reserve(onchain, token["id"], address)
+            variable_debt = 0 if reserve is None else reserve[2]
             balances = (0, variable_debt)
         elif version == "v3":
             balances = (
@@ -134,23 +476,21 @@ def get_borrow_positions(borrow_positions, address, version, blockchain):
 
         modes = ("STABLE", "VARIABLE")
 
-        for i in range(2):
-            if int(balances[i]) == 0:
+        for mode, amount_raw in zip(modes, balances):
+            if int(amount_raw) == 0:
                 continue
-            mode = modes[i]
-            amount_raw = balances[i]
             amount = to_readable(amount_raw, decimals)
             value = amount * float(price)
-            apy = float([r["rate"] for r in rates if r["type"] == modes[i]][0])
-
-            borrow = {
-                "name": name,
-                "symbol": symbol,
-                "amount": amount,
-                "value": value,
-                "apy": apy,
-                "mode": mode,
-            }
+            apy = float([r["rate"] for r in rates if r["type"] == mode][0])
+
+            borrow = BorrowPosition(
+                name=name,
+                symbol=symbol,
+                amount=amount,
+                value=value,
+                apy=apy,
+                mode=mode,
+            )
 
             total_balance += value
             apys.append(apy)
@@ -168,111 +508,150 @@ def get_borrow_positions(borrow_positions, address, version, blockchain):
     return data
 
 
-def get_lend_positions_for_revenue(address, version, blockchain):
-    params = {"id": address.lower()}
-    response = requests.post(
-        f"https://api.thegraph.com/subgraphs/name/messari/aave-{version}-{blockchain}",
-        json={"query": queries["lend_revenue"], "variables": params},
+def lend_balance(reserve):
+    return reserve[0]
+
+
+def borrow_balance(reserve):
+    return sum(reserve[1:2])
+
+
+def apply_checkpoints(positions, inflow, outflow, checkpoints):
+    # Drops what a position's checkpoint already covers, returning the
+    # remaining positions and the balance each one resumes from
+    deltas, initial_balances = [], []
+    for position in positions:
+        cp = checkpoints.get(position["id"])
+        if cp is None:
+            deltas.append(position)
+            initial_balances.append(0)
+            continue
+        delta = dict(position)
+        for key in (inflow, outflow, "snapshots"):
+            delta[key] = [
+                e for e in position[key] if int(e["timestamp"]) > cp["timestamp"]
+            ]
+        deltas.append(delta)
+        initial_balances.append(cp["prev_balance"])
+    return deltas, initial_balances
+
+
+def next_checkpoints(positions, deltas, inflow, outflow, realized, last, checkpoints):
+    # Every position is complete up to the newest timestamp seen on this side,
+    # or its own checkpoint when that is newer, its events up to there are
+    # already folded in. A checkpoint is only kept while events and snapshots
+    # pair up one to one, otherwise that position is recomputed from scratch
+    # next time
+    timestamps = [get_since(checkpoints)]
+    for delta in deltas:
+        for key in (inflow, outflow, "snapshots"):
+            timestamps += [int(e["timestamp"]) for e in delta[key]]
+    synced = max(timestamps)
+
+    result = {}
+    for position, delta, pnl, balance in zip(positions, deltas, realized, last):
+        cp = checkpoints.get(position["id"], {"events": 0, "snapshots": 0})
+        events = cp["events"] + len(delta[inflow]) + len(delta[outflow])
+        snapshots = cp["snapshots"] + len(delta["snapshots"])
+        if events != snapshots:
+            continue
+        result[position["id"]] = {
+            "asset": position["market"]["inputToken"]["id"],
+            "timestamp": max(synced, cp.get("timestamp", 0)),
+            "prev_balance": float(balance),
+            "realized": float(pnl),
+            "events": events,
+            "snapshots": snapshots,
+        }
+    return result
+
+
+async def get_pnl(
+    address,
+    positions,
+    inflow,
+    outflow,
+    reserve_balance,
+    version,
+    blockchain,
+    onchain,
+    checkpoints=None,
+):
+    checkpoints = checkpoints or {}
+    deltas, initial_balances = apply_checkpoints(
+        positions, inflow, outflow, checkpoints
     )
-    data = response.json()
-    return data["data"]["account"]["positions"]
-
+    realized, last_balances = realized_pnl(deltas, inflow, outflow, initial_balances)
+    for i, position in enumerate(positions):
+        if position["id"] in checkpoints:
+            realized[i] += checkpoints[position["id"]]["realized"]
+
+    # Positions with a remaining balance are still accruing interest
+    open_positions = [p for p, last in zip(positions, last_balances) if last != 0]
+    if onchain is None and len(open_positions) > 0:
+        assets = get_position_assets(open_positions)
+        onchain = await get_onchain_data(address, assets, version, blockchain)
+
+    results = []
+    for position, pnl, prev_balance in zip(positions, realized, last_balances):
+        token = position["market"]["inputToken"]
+        pnl = float(pnl)
+        if prev_balance != 0:
+            reserve = get_reserve(onchain, token["id"], address)
+            latest_price = onchain["prices"][token["id"].lower()]
+            latest_balance = 0 if reserve is None else reserve_balance(reserve)
+            # If 0, the balance was removed by other means than withdraw/repay,
+            # ignore this case
+            if latest_balance != 0:
+                accrued_amount = (latest_balance - prev_balance) / 10 ** int(
+                    token["decimals"]
+                )
+                pnl += accrued_amount * latest_price
+
+        results.append(
+            {
+                "market": position["market"]["name"],
+                "symbol": token["symbol"],
+                "pnl": pnl,
+            }
+        )
 
-def get_borrow_positions_for_cost(address, version, blockchain):
-    params = {"id": address.lower()}
-    response = requests.post(
-        f"https://api.thegraph.com/subgraphs/name/messari/aave-{version}-{blockchain}",
-        json={"query": queries["borrow_cost"], "variables": params},
-    )
-    data = response.json()
-    return data["data"]["account"]["positions"]
+    return {
+        "total": sum(r["pnl"] for r in results),
+        "positions": results,
+        "checkpoints": next_checkpoints(
+            positions, deltas, inflow, outflow, realized, last_balances, checkpoints
+        ),
+    }
 
 
-def get_lend_revenue(address, position, version, blockchain):
-    token = position["market"]["inputToken"]
-    token_address = token["id"]
-    decimals = token["decimals"]
+async def get_lend_revenues(
+    address, positions, version, blockchain, onchain=None, checkpoints=None
+):
+    return await get_pnl(
+        address,
+        positions,
+        "deposits",
+        "withdraws",
+        lend_balance,
+        version,
+        blockchain,
+        onchain,
+        checkpoints,
+    )
 
-    events = []
-    for deposit in position["deposits"]:
-        deposit["action"] = "deposit"
-        events.append(deposit)
-
-    for withdraw in position["withdraws"]:
-        withdraw["action"] = "withdraw"
-        events.append(withdraw)
-    events.sort(key=lambda x: x["timestamp"])
-
-    snapshots = position["snapshots"]
-    snapshots.sort(key=lambda x: x["timestamp"])
-
-    total_revenue = 0
-    prev_balance = 0
-    for event, snapshot in zip(events, snapshots):
-        cur_balance = int(snapshot["balance"])
-        if event["action"] == "withdraw":
-            amount = int(event["amount"])
-            value = float(event["amountUSD"])
-            price = value / amount  # Dollars/Wei
-            balance_before_withdraw = amount + cur_balance
-            revenue = (balance_before_withdraw - prev_balance) * price
-            total_revenue += revenue
-
-        prev_balance = cur_balance
-    if prev_balance != 0:  # There is remaining deposit that is accruing interest
-        provider = providers[version][blockchain]
-        latest_balance = provider.get_user_reserve_data(token_address, address)[0]
-        # If 0, aToken were removed by other means than withdrawal, ignore this case
-        if latest_balance != 0:
-            accrued_amount = (latest_balance - prev_balance) / 10**decimals
-            latest_price = provider.get_asset_price(token_address)
-            accrued_value = accrued_amount * latest_price
-            total_revenue += accrued_value
-
-    return total_revenue
-
-
-def get_borrow_cost(address, position, version, blockchain):
-    token = position["market"]["inputToken"]
-    token_address = token["id"]
-    decimals = token["decimals"]
 
-    events = []
-    for borrow in position["borrows"]:
-        borrow["action"] = "borrow"
-        events.append(borrow)
-
-    for repay in position["repays"]:
-        repay["action"] = "repay"
-        events.append(repay)
-    events.sort(key=lambda x: x["timestamp"])
-
-    snapshots = position["snapshots"]
-    snapshots.sort(key=lambda x: x["timestamp"])
-
-    total_cost = 0
-    prev_balance = 0
-    for event, snapshot in zip(events, snapshots):
-        cur_balance = int(snapshot["balance"])
-        if event["action"] == "repay":
-            amount = int(event["amount"])
-            value = float(event["amountUSD"])
-            price = value / amount
-            balance_before_repay = amount + cur_balance
-            cost = (balance_before_repay - prev_balance) * price
-            total_cost += cost
-
-        prev_balance = cur_balance
-    if prev_balance != 0:  # There is remaining deposit that is accruing interest
-        provider = providers[version][blockchain]
-        latest_balance = sum(
-            provider.get_user_reserve_data(token_address, address)[1:2]
-        )
-        # If 0, aToken were removed by other means than withdrawal, ignore this case
-        if latest_balance != 0:
-            accrued_amount = (latest_balance - prev_balance) / 10**decimals
-            latest_price = provider.get_asset_price(token_address)
-            accrued_cost = accrued_amount * latest_price
-            total_cost += accrued_cost
-
-    return total_cost
+async def get_borrow_costs(
+    address, positions, version, blockchain, onchain=None, checkpoints=None
+):
+    return await get_pnl(
+        address,
+        positions,
+        "borrows",
+        "repays",
+        borrow_balance,
+        version,
+        blockchain,
+        onchain,
+        checkpoints,
+    )
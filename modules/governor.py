@@ -0,0 +1,194 @@
+import asyncio
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from modules.deadline import remaining
+from modules.metrics import Counter
+
+# Every upstream host gets a concurrency limit and a token bucket refilled at
+# its request rate. Failed calls are retried with jittered exponential backoff
+# when the error is worth retrying, and a 429 pauses the whole host for its
+# Retry-After. The defaults only guard against runaway load, one /account
+# for a large account fans out to ~30 subgraph queries at once and the
+# bucket holds UPSTREAM_BURST tokens so that goes through unthrottled.
+# Hosts with a known quota are set in UPSTREAM_LIMITS as comma-separated
+# host=concurrency:rate[:burst] entries, the burst defaults to one second of
+# the rate there, e.g.
+#   UPSTREAM_LIMITS=api.thegraph.com=32:200:300,rpc.ankr.com=16:30
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", 64))
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", 500))  # requests per second
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", 200))
+UPSTREAM_LIMITS = os.environ.get("UPSTREAM_LIMITS", "")
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 3))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", 0.2))
+UPSTREAM_MAX_BACKOFF = float(os.environ.get("UPSTREAM_MAX_BACKOFF", 10))
+
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# JSON-RPC error codes nodes use for rate limits
+RETRYABLE_RPC_CODES = {-32005, 429}
+
+upstream_retries = Counter(
+    "upstream_retries_total", "Upstream calls retried after an error", ("upstream",)
+)
+upstream_throttled = Counter(
+    "upstream_throttled_total", "Upstream 429 responses", ("host",)
+)
+
+governors = {}  # host -> Governor
+
+
+class UpstreamPaused(Exception):
+    # The host is paused for longer than the caller can wait
+    pass
+
+
+class Governor:
+    def __init__(self, host, concurrency, rate, burst):
+        self.host = host
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def paused(self, now):
+        return now < self.paused_until
+
+    def pause(self, seconds):
+        seconds = min(seconds, UPSTREAM_MAX_BACKOFF)
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def take(self):
+        # Waits out a pause, then for a token. A pause longer than
+        # UPSTREAM_MAX_BACKOFF or the deadline fails fast instead
+        while True:
+            now = time.monotonic()
+            if self.paused(now):
+                wait = self.paused_until - now
+                left = remaining()
+                if wait > UPSTREAM_MAX_BACKOFF or (left is not None and wait >= left):
+                    raise UpstreamPaused(f"{self.host} is paused for {wait:.1f}s")
+                await asyncio.sleep(wait)
+                continue
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def run(self, fn):
+        async with self.semaphore:
+            await self.take()
+            try:
+                return await fn()
+            except aiohttp.ClientResponseError as e:
+                if e.status == 429:
+                    upstream_throttled.inc(self.host)
+                    self.pause(retry_after(e) or UPSTREAM_BACKOFF)
+                raise
+
+
+def parse_limits(limits):
+    overrides = {}
+    for entry in limits.split(","):
+        if entry.strip() == "":
+            continue
+        host, values = entry.strip().split("=")
+        concurrency, rate, *burst = values.split(":")
+        rate = float(rate)
+        overrides[host] = (int(concurrency), rate, float(burst[0]) if burst else rate)
+    return overrides
+
+
+overrides = parse_limits(UPSTREAM_LIMITS)
+
+
+def get_governor(url):
+    host = urlsplit(url).netloc
+    governor = governors.get(host)
+    if governor is None:
+        limits = overrides.get(
+            host, (UPSTREAM_CONCURRENCY, UPSTREAM_RATE, UPSTREAM_BURST)
+        )
+        governor = Governor(host, *limits)
+        governors[host] = governor
+    return governor
+
+
+def parse_retry_after(value):
+    # Retry-After is either seconds or an HTTP date
+    if value is None:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+def retry_after(error):
+    # Seconds the upstream asked us to wait, None when the error is fatal
+    if isinstance(error, aiohttp.ClientResponseError):
+        if error.status not in RETRYABLE_STATUSES:
+            return None
+        return parse_retry_after((error.headers or {}).get("Retry-After"))
+    if isinstance(
+        error,
+        (
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return 0
+    if isinstance(error, ValueError) and len(error.args) > 0:
+        # web3 raises the JSON-RPC error object as a ValueError
+        rpc_error = error.args[0]
+        if isinstance(rpc_error, dict) and rpc_error.get("code") in RETRYABLE_RPC_CODES:
+            return 0
+    return None
+
+
+def backoff(attempt, wait):
+    return max(
+        wait,
+        random.uniform(0, min(UPSTREAM_MAX_BACKOFF, UPSTREAM_BACKOFF * 2**attempt)),
+    )
+
+
+async def retrying(fn, upstream, retries=UPSTREAM_RETRIES):
+    # fn is called again for every attempt. Gives up on fatal errors, after
+    # `retries` retries, when the upstream asks for a longer wait than
+    # UPSTREAM_MAX_BACKOFF or when the wait would outlast the deadline
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            wait = retry_after(e)
+            if wait is None or attempt >= retries or wait > UPSTREAM_MAX_BACKOFF:
+                raise
+            delay = backoff(attempt, wait)
+            left = remaining()
+            if left is not None and delay >= left:
+                raise
+            upstream_retries.inc(upstream)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def call(url, fn, retries=UPSTREAM_RETRIES):
+    governor = get_governor(url)
+    return await retrying(lambda: governor.run(fn), governor.host, retries)
@@ -0,0 +1,40 @@
+import os
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# One keep-alive connection pool per upstream host, shared by the subgraph
+# client and the RPC endpoints. aiohttp asks for gzip/deflate and decodes it
+# by default. It only speaks HTTP/1.1, so reusing connections is what saves
+# the TLS handshakes
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 32))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 60))
+HTTP_DNS_TTL = float(os.environ.get("HTTP_DNS_TTL", 300))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+
+sessions = {}  # host -> ClientSession
+
+
+def get_session(url):
+    host = urlsplit(url).netloc
+    session = sessions.get(host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=HTTP_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT
+        )
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        sessions[host] = session
+    return session
+
+
+async def close_sessions():
+    for session in sessions.values():
+        if not session.closed:
+            await session.close()
+    sessions.clear()
@@ -0,0 +1,49 @@
+import asyncio
+import os
+import time
+
+from modules.query import queries
+from modules.subgraph import SubgraphError, request_subgraph
+
+# Market metadata (tokens, decimals, rates, prices) per (version, market).
+# Account queries only select market ids and are joined against this
+MARKET_CATALOG_TTL = float(os.environ.get("MARKET_CATALOG_TTL", 60))
+
+catalogs = {}  # (version, market) -> (fetched_at, {market id: market})
+refreshing = {}  # (version, market) -> background refresh task
+
+
+async def fetch_market_catalog(version, market):
+    data = await request_subgraph(queries["markets"], {}, version, market, "markets")
+    if "errors" in data:
+        raise SubgraphError(data["errors"])
+    catalog = {m["id"]: m for m in data["data"]["markets"]}
+    catalogs[(version, market)] = (time.monotonic(), catalog)
+    return catalog
+
+
+def refresh_in_background(version, market):
+    key = (version, market)
+    if key in refreshing:
+        return
+
+    def done(task):
+        refreshing.pop(key, None)
+        # Keep the old catalog if the refresh fails
+        if not task.cancelled():
+            task.exception()
+
+    task = asyncio.create_task(fetch_market_catalog(version, market))
+    refreshing[key] = task
+    task.add_done_callback(done)
+
+
+async def get_market_catalog(version, market, ids=()):
+    # Refetches right away when a market in ids is unknown, otherwise an
+    # expired catalog is still served while it refreshes in the background
+    entry = catalogs.get((version, market))
+    if entry is None or any(i not in entry[1] for i in ids):
+        return await fetch_market_catalog(version, market)
+    if time.monotonic() - entry[0] > MARKET_CATALOG_TTL:
+        refresh_in_background(version, market)
+    return entry[1]
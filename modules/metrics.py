@@ -0,0 +1,166 @@
+import time
+from contextlib import contextmanager
+
+# Prometheus text exposition for this worker. With several gunicorn workers
+# each scrape sees the process that answered it
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values -> value
+        registry.append(self)
+
+    def samples(self):
+        for values, value in self.values.items():
+            yield self.name, format_labels(self.labels, values), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values, amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *values, amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+    def set(self, *values, value):
+        self.values[values] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, *values, value):
+        # [count per bucket..., count, sum], buckets are not cumulative here
+        state = self.values.setdefault(values, [0] * (len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += 1
+        state[-1] += value
+
+    def samples(self):
+        for values, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state[: len(self.buckets)]):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), values + (bound,))
+                yield f"{self.name}_bucket", labels, cumulative
+            # Values above the top bound are only in the total count
+            labels = format_labels(self.labels + ("le",), values + ("+Inf",))
+            yield f"{self.name}_bucket", labels, state[-2]
+            labels = format_labels(self.labels, values)
+            yield f"{self.name}_count", labels, state[-2]
+            yield f"{self.name}_sum", labels, state[-1]
+
+
+class Upstream:
+    # Latency, errors and in-flight requests of one kind of upstream call
+    def __init__(self, name, help, labels):
+        self.latency = Histogram(f"{name}_duration_seconds", f"{help} latency", labels)
+        self.errors = Counter(f"{name}_errors_total", f"{help} errors", labels)
+        self.in_flight = Gauge(f"{name}_in_flight", f"{help} in flight", labels)
+
+    @contextmanager
+    def track(self, *values):
+        self.in_flight.inc(*values)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors.inc(*values)
+            raise
+        finally:
+            self.latency.observe(*values, value=time.perf_counter() - start)
+            self.in_flight.dec(*values)
+
+
+subgraph_requests = Upstream(
+    "subgraph_request", "Subgraph queries", ("version", "market", "query")
+)
+rpc_requests = Upstream("rpc_request", "JSON-RPC eth_calls", ("chain", "method"))
+rpc_batched_calls = Counter(
+    "rpc_batched_calls_total",
+    "Contract calls sent inside multicalls",
+    ("chain", "method"),
+)
+rpc_failed_calls = Counter(
+    "rpc_failed_calls_total",
+    "Contract calls that failed inside multicalls",
+    ("chain", "method"),
+)
+http_requests = Upstream("http_request", "API requests", ("method", "path"))
+http_responses = Counter(
+    "http_responses_total", "API responses", ("method", "path", "status")
+)
+
+
+cache_fields = {
+    "hits": "counter",
+    "stale_hits": "counter",
+    "misses": "counter",
+    "hit_ratio": "gauge",
+    "size": "gauge",
+    "bytes": "gauge",
+}
+
+
+def render_caches(caches):
+    # caches is name -> object whose stats() dict has some of cache_fields
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    lines = []
+    for field, kind in cache_fields.items():
+        name = f"cache_{field}" + ("_total" if kind == "counter" else "")
+        lines += [f"# HELP {name} Cache {field}", f"# TYPE {name} {kind}"]
+        for cache_name, values in stats.items():
+            if field in values:
+                labels = format_labels(("cache",), (cache_name,))
+                lines.append(f"{name}{labels} {values[field]}")
+    return lines
+
+
+def render(caches):
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    lines += render_caches(caches)
+    return "\n".join(lines) + "\n"
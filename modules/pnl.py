@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def group_ranks(groups, size):
+    # Position of each row within its group, for rows already sorted by group
+    counts = np.bincount(groups, minlength=size)
+    starts = np.cumsum(counts) - counts
+    return np.arange(len(groups)) - np.repeat(starts, counts), counts, starts
+
+
+def load_events(positions, inflow, outflow):
+    groups, timestamps, is_outflow, amounts, values = [], [], [], [], []
+    for i, position in enumerate(positions):
+        for outgoing, key in ((False, inflow), (True, outflow)):
+            events = position[key]
+            groups += [i] * len(events)
+            is_outflow += [outgoing] * len(events)
+            timestamps += [int(event["timestamp"]) for event in events]
+            amounts += [float(event["amount"]) for event in events]
+            values += [float(event["amountUSD"]) for event in events]
+    return (
+        np.array(groups, dtype=np.int64),
+        np.array(timestamps, dtype=np.int64),
+        np.array(is_outflow, dtype=bool),
+        np.array(amounts, dtype=np.float64),
+        np.array(values, dtype=np.float64),
+    )
+
+
+def load_snapshots(positions):
+    groups, timestamps, balances = [], [], []
+    for i, position in enumerate(positions):
+        snapshots = position["snapshots"]
+        groups += [i] * len(snapshots)
+        timestamps += [int(snapshot["timestamp"]) for snapshot in snapshots]
+        balances += [float(snapshot["balance"]) for snapshot in snapshots]
+    return (
+        np.array(groups, dtype=np.int64),
+        np.array(timestamps, dtype=np.int64),
+        np.array(balances, dtype=np.float64),
+    )
+
+
+def realized_pnl(positions, inflow, outflow, initial_balances=None):
+    # For every position, the k-th event (inflows before outflows on equal
+    # timestamps) is paired with the k-th snapshot. Each outflow realizes
+    # (amount + balance after - balance before) at the outflow's USD price.
+    # Returns the realized PnL and the last paired balance per position.
+    # initial_balances are the balances before the first event, when only
+    # the events after a checkpoint are passed in
+    size = len(positions)
+    if initial_balances is None:
+        initial_balances = np.zeros(size)
+    initial_balances = np.asarray(initial_balances, dtype=np.float64)
+    groups, timestamps, is_outflow, amounts, values = load_events(
+        positions, inflow, outflow
+    )
+    order = np.lexsort((timestamps, groups))
+    groups, is_outflow = groups[order], is_outflow[order]
+    amounts, values = amounts[order], values[order]
+    ranks, event_counts, _ = group_ranks(groups, size)
+
+    snapshot_groups, snapshot_timestamps, balances = load_snapshots(positions)
+    balances = balances[np.lexsort((snapshot_timestamps, snapshot_groups))]
+    snapshot_counts = np.bincount(snapshot_groups, minlength=size)
+    snapshot_starts = np.cumsum(snapshot_counts) - snapshot_counts
+
+    pairs = np.minimum(event_counts, snapshot_counts)
+    paired = ranks < pairs[groups]
+    groups, ranks, is_outflow = groups[paired], ranks[paired], is_outflow[paired]
+    amounts, values = amounts[paired], values[paired]
+
+    index = snapshot_starts[groups] + ranks
+    current = balances[index]
+    previous = np.where(ranks > 0, balances[index - 1], initial_balances[groups])
+
+    realizing = is_outflow & (amounts != 0)
+    price = np.divide(values, amounts, out=np.zeros_like(values), where=realizing)
+    pnl = (amounts + current - previous) * price
+    # bincount gives ints when there is nothing to weigh
+    realized = np.bincount(groups, weights=pnl, minlength=size).astype(np.float64)
+
+    last = initial_balances.copy()
+    has_pairs = pairs > 0
+    last[has_pairs] = balances[(snapshot_starts + pairs - 1)[has_pairs]]
+    return realized, last
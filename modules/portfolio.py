@@ -0,0 +1,72 @@
+import asyncio
+import os
+
+import numpy as np
+
+from modules.account import get_cached_account
+from modules.providers import providers
+
+# Seconds each market gets before it is reported as partial. Builds that
+# time out keep running in the background and fill the account cache
+MARKET_TIMEOUT = float(os.environ.get("PORTFOLIO_MARKET_TIMEOUT", 10))
+
+
+def get_markets():
+    return [(version, chain) for version in providers for chain in providers[version]]
+
+
+async def get_market(address, version, market, timeout):
+    try:
+        result = await asyncio.wait_for(
+            get_cached_account(address, version, market), timeout
+        )
+    except asyncio.TimeoutError:
+        return {"status": "timeout"}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+    data = result["data"]
+    if data is None:
+        return {"status": "empty"}
+    if "missing" in result:
+        # Joined an /account build that ran out of time
+        return {"status": "timeout"}
+    return {
+        "status": "ok",
+        "lend_positions": data["lend_positions"],
+        "borrow_positions": data["borrow_positions"],
+        "lend_revenue": data["lend_revenue"],
+        "borrow_cost": data["borrow_cost"],
+    }
+
+
+def weighted_apy(positions):
+    balances = [p["balance"] for p in positions]
+    if sum(balances) == 0:
+        return 0
+    return np.average([p["apy"] for p in positions], weights=balances)
+
+
+async def get_portfolio(address, timeout=MARKET_TIMEOUT):
+    markets = get_markets()
+    results = await asyncio.gather(
+        *(get_market(address, version, market, timeout) for version, market in markets)
+    )
+
+    breakdown = []
+    for (version, market), result in zip(markets, results):
+        breakdown.append({"version": version, "market": market, **result})
+    loaded = [m for m in breakdown if m["status"] == "ok"]
+    lends = [m["lend_positions"] for m in loaded]
+    borrows = [m["borrow_positions"] for m in loaded]
+
+    return {
+        "lend_balance": sum(p["balance"] for p in lends),
+        "lend_apy": weighted_apy(lends),
+        "borrow_balance": sum(p["balance"] for p in borrows),
+        "borrow_apy": weighted_apy(borrows),
+        "lend_revenue": sum(m["lend_revenue"] for m in loaded),
+        "borrow_cost": sum(m["borrow_cost"] for m in loaded),
+        "partial": any(m["status"] in ("timeout", "error") for m in breakdown),
+        "markets": [m for m in breakdown if m["status"] != "empty"],
+    }
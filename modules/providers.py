@@ -1,8 +1,25 @@
+import asyncio
+import os
+from collections.abc import Mapping
+from functools import lru_cache
+
+from hexbytes import HexBytes
 from web3 import Web3
+from web3._utils.abi import get_abi_output_types
+
+from modules.cache import TTLCache
+from modules.deadline import bounded
+from modules.metrics import rpc_batched_calls, rpc_failed_calls, rpc_requests
+from modules.rpcpool import EndpointPool
+from modules.singleflight import SingleFlight
+from modules.timing import span
 
 blockchains = {
     "arbitrum": {
-        "rpc": "https://arb1.arbitrum.io/rpc",
+        "rpcs": [
+            "https://arb1.arbitrum.io/rpc",
+            "https://rpc.ankr.com/arbitrum",
+        ],
         "oracle": "0xb56c2F0B653B2e0b10C9b928C8580Ac5Df02C7C7",
         "contracts": [
             {
@@ -12,7 +29,10 @@ blockchains = {
         ],
     },
     "avalanche": {
-        "rpc": "https://api.avax.network/ext/bc/C/rpc",
+        "rpcs": [
+            "https://api.avax.network/ext/bc/C/rpc",
+            "https://rpc.ankr.com/avalanche",
+        ],
         "oracle": "0xEBd36016B3eD09D4693Ed4251c67Bd858c3c7C9C",
         "contracts": [
             {
@@ -26,7 +46,11 @@ blockchains = {
         ],
     },
     "ethereum": {
-        "rpc": "https://eth-rpc.gateway.pokt.network",
+        "rpcs": [
+            "https://eth-rpc.gateway.pokt.network",
+            "https://rpc.ankr.com/eth",
+            "https://cloudflare-eth.com",
+        ],
         "oracle": "0xA50ba011c48153De246E5192C8f9258A2ba79Ca9",
         "contracts": [
             {
@@ -36,7 +60,10 @@ blockchains = {
         ],
     },
     "fantom": {
-        "rpc": "https://rpc.ankr.com/fantom/",
+        "rpcs": [
+            "https://rpc.ankr.com/fantom/",
+            "https://rpc.ftm.tools",
+        ],
         "oracle": "0xfd6f3c1845604C8AE6c6E402ad17fb9885160754",
         "contracts": [
             {
@@ -46,7 +73,10 @@ blockchains = {
         ],
     },
     "harmony": {
-        "rpc": "https://api.harmony.one",
+        "rpcs": [
+            "https://api.harmony.one",
+            "https://rpc.ankr.com/harmony",
+        ],
         "oracle": "0x3C90887Ede8D65ccb2777A5d577beAb2548280AD",
         "contracts": [
             {
@@ -56,7 +86,10 @@ blockchains = {
         ],
     },
     "optimism": {
-        "rpc": "https://mainnet.optimism.io",
+        "rpcs": [
+            "https://mainnet.optimism.io",
+            "https://rpc.ankr.com/optimism",
+        ],
         "oracle": "0xD81eb3728a631871a7eBBaD631b5f424909f0c77",
         "contracts": [
             {
@@ -66,7 +99,10 @@ blockchains = {
         ],
     },
     "polygon": {
-        "rpc": "https://polygon-rpc.com",
+        "rpcs": [
+            "https://polygon-rpc.com",
+            "https://rpc.ankr.com/polygon",
+        ],
         "oracle": "0xb023e699F5a33916Ea823A16485e259257cA8Bd1",
         "contracts": [
             {
@@ -149,62 +185,282 @@ eth_oracle_abi = [
 ]
 
 
+# Multicall3 is deployed at the same address on every chain above
+multicall_address = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL_CHUNK_SIZE = int(os.environ.get("MULTICALL_CHUNK_SIZE", 500))
+
+multicall_abi = [
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"internalType": "address", "name": "target", "type": "address"},
+                    {"internalType": "bool", "name": "allowFailure", "type": "bool"},
+                    {"internalType": "bytes", "name": "callData", "type": "bytes"},
+                ],
+                "internalType": "struct Multicall3.Call3[]",
+                "name": "calls",
+                "type": "tuple[]",
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"internalType": "bool", "name": "success", "type": "bool"},
+                    {"internalType": "bytes", "name": "returnData", "type": "bytes"},
+                ],
+                "internalType": "struct Multicall3.Result[]",
+                "name": "returnData",
+                "type": "tuple[]",
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function",
+    },
+]
+
+call_flight = SingleFlight()
+
+# Calls are pinned to a block number that is resolved once per chain and
+# reused for BLOCK_TTL seconds. What a call returns at a fixed block never
+# changes, so decoded results are cached by (chain, block, target, calldata)
+# and only age out to bound memory. Oracle prices are cached this way too,
+# so reserves and prices in one answer always come from the same block
+BLOCK_TTL = float(os.environ.get("BLOCK_TTL", 2))
+block_numbers = TTLCache(64, BLOCK_TTL)
+block_cache = TTLCache(
+    int(os.environ.get("BLOCK_CACHE_SIZE", 65536)),
+    float(os.environ.get("BLOCK_CACHE_TTL", 120)),
+)
+
+
+# Contract objects are only used to encode calldata and look up ABIs, the
+# calls themselves go through each Provider's async Web3 instance
+abi_w3 = Web3()
+
+
+abis = {
+    "data": data_abi,
+    "oracle": oracle_abi,
+    "eth_oracle": eth_oracle_abi,
+    "multicall": multicall_abi,
+}
+
+
+@lru_cache(maxsize=None)
+def get_contract(address, abi_name):
+    # The same contracts are deployed at the same address on several chains
+    return abi_w3.eth.contract(
+        address=Web3.toChecksumAddress(address), abi=abis[abi_name]
+    )
+
+
+@lru_cache(maxsize=None)
+def get_output_types(contract, fn_name):
+    return get_abi_output_types(contract.get_function_by_name(fn_name).abi)
+
+
 class Provider:
-    def __init__(self, chain, rpc_url, oracle, contract_address):
+    def __init__(self, chain, pool, oracle, contract_address):
         self.chain = chain
-        provider = Web3.HTTPProvider(rpc_url)
-        self.w3 = Web3(provider)
-        self.oracle = self.w3.eth.contract(
-            address=Web3.toChecksumAddress(oracle), abi=oracle_abi
-        )
-        self.data_contract = self.w3.eth.contract(
-            address=Web3.toChecksumAddress(contract_address), abi=data_abi
-        )
+        self.pool = pool
+        self.oracle = get_contract(oracle, "oracle")
+        self.data_contract = get_contract(contract_address, "data")
         if chain == "ethereum":  # Chainlink ETH/USD oracle
-            self.eth_oracle = self.w3.eth.contract(
-                address=Web3.toChecksumAddress(
-                    "0x5f4eC3Df9cbd43714FE2740f5E3616155c5b8419"
-                ),
-                abi=eth_oracle_abi,
+            self.eth_oracle = get_contract(
+                "0x5f4eC3Df9cbd43714FE2740f5E3616155c5b8419", "eth_oracle"
             )
+        self.multicall_contract = get_contract(multicall_address, "multicall")
+
+    def decode(self, contract, fn_name, raw):
+        output_types = get_output_types(contract, fn_name)
+        result = abi_w3.codec.decode_abi(output_types, raw)
+        if len(result) == 1:
+            return result[0]
+        return list(result)
+
+    async def get_block(self):
+        block = block_numbers.get(self.chain)
+        if block is None:
+            with span(f"rpc.{self.chain}.blockNumber"):
+                block = await bounded(
+                    call_flight.do((self.chain, "blockNumber"), self.observe_block)
+                )
+            block_numbers.set(self.chain, block)
+        return block
+
+    async def observe_block(self):
+        with rpc_requests.track(self.chain, "blockNumber"):
+            return await self.pool.block_number()
+
+    async def fetch(self, contract, fn_name, data, block):
+        # Identical eth_calls in flight on this chain share one request
+        key = (self.chain, block, contract.address, data)
+        tx = {"to": contract.address, "data": data}
+        with span(f"rpc.{self.chain}.{fn_name}"):
+            raw = await bounded(
+                call_flight.do(key, self.observe_call, fn_name, tx, block)
+            )
+        return self.decode(contract, fn_name, raw)
+
+    async def observe_call(self, fn_name, tx, block):
+        with rpc_requests.track(self.chain, fn_name):
+            return await self.pool.call(tx, block)
 
-    def get_user_reserve_data(self, asset, address):
-        result = self.data_contract.functions.getUserReserveData(
-            Web3.toChecksumAddress(asset),
-            Web3.toChecksumAddress(address),
-        ).call()
-
-        return result
-
-    def get_asset_price(self, asset):
-        try:
-            result = (
-                self.oracle.functions.getAssetPrice(
-                    Web3.toChecksumAddress(asset)
-                ).call()
-                / 10**8
+    async def multicall(self, calls):
+        # calls is a list of (contract, fn_name, args), a failed call gives None
+        # in its slot instead of reverting the whole batch. Calls already
+        # answered at this block are served from the block cache
+        block = await self.get_block()
+        keys = [
+            (self.chain, block, contract.address, contract.encodeABI(fn_name, args))
+            for contract, fn_name, args in calls
+        ]
+        decoded = [block_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(decoded) if result is None]
+        requests = [(keys[i][2], True, HexBytes(keys[i][3])) for i in missing]
+        # Large batches are split so each eth_call stays under RPC gas caps
+        chunks = await asyncio.gather(
+            *(
+                self.fetch(
+                    self.multicall_contract,
+                    "aggregate3",
+                    self.multicall_contract.encodeABI(
+                        "aggregate3", [requests[i : i + MULTICALL_CHUNK_SIZE]]
+                    ),
+                    block,
+                )
+                for i in range(0, len(requests), MULTICALL_CHUNK_SIZE)
             )
-            if self.chain == "ethereum":
-                eth_price = (
-                    self.eth_oracle.functions.latestAnswer().call() / 10**8
-                )  # Dollar/Eth
-                result /= 10**10
-                result *= eth_price
-        except:
+        )
+        results = [result for chunk in chunks for result in chunk]
+
+        for i, (success, raw) in zip(missing, results):
+            contract, fn_name, _ = calls[i]
+            rpc_batched_calls.inc(self.chain, fn_name)
+            try:
+                decoded[i] = self.decode(contract, fn_name, raw) if success else None
+            except Exception:
+                decoded[i] = None
+            if decoded[i] is None:
+                rpc_failed_calls.inc(self.chain, fn_name)
+            else:
+                block_cache.set(keys[i], decoded[i])
+        return decoded
+
+    def to_price(self, price, eth_price=None):
+        if price is None:
             return 0
+        result = price / 10**8
+        if self.chain == "ethereum":
+            if eth_price is None:
+                return 0
+            result /= 10**10
+            result *= eth_price / 10**8  # Dollar/Eth
         return result  # Dollar/Unit
 
+    async def get_reserves_and_prices(self, pairs, assets=()):
+        # Prices are returned for the assets of every pair plus `assets`
+        pairs = list(dict.fromkeys((a.lower(), u.lower()) for a, u in pairs))
+        assets = [asset for asset, _ in pairs] + [asset.lower() for asset in assets]
+        assets = list(dict.fromkeys(assets))
+
+        calls = [
+            (
+                self.data_contract,
+                "getUserReserveData",
+                (Web3.toChecksumAddress(asset), Web3.toChecksumAddress(user)),
+            )
+            for asset, user in pairs
+        ]
+        calls += [
+            (self.oracle, "getAssetPrice", (Web3.toChecksumAddress(asset),))
+            for asset in assets
+        ]
+        fetch_eth_price = self.chain == "ethereum" and len(assets) > 0
+        if fetch_eth_price:
+            calls.append((self.eth_oracle, "latestAnswer", ()))
+
+        results = await self.multicall(calls)
+        eth_price = results.pop() if fetch_eth_price else None
+        prices = {
+            asset: self.to_price(price, eth_price)
+            for asset, price in zip(assets, results[len(pairs) :])
+        }
+        return {
+            "reserves": dict(zip(pairs, results[: len(pairs)])),
+            "prices": prices,
+        }
+
+
+# Replaces every chain's RPC endpoints when set, {chain} is filled in.
+# RPC_URLS_<CHAIN> replaces one chain's list with comma-separated URLs
+RPC_URL = os.environ.get("RPC_URL")
 
-providers = {}
 
+def get_rpc_urls(chain):
+    if RPC_URL is not None:
+        return [RPC_URL.format(chain=chain)]
+    urls = os.environ.get(f"RPC_URLS_{chain.upper()}")
+    if urls is not None:
+        return [url.strip() for url in urls.split(",") if url.strip() != ""]
+    return blockchains[chain]["rpcs"]
+
+
+class LazyMapping(Mapping):
+    # A fixed set of keys whose values are built on first access. Values
+    # built before a fork are dropped in the child, which builds its own
+    def __init__(self, keys, build):
+        self.keys_ = list(keys)
+        self.build = build
+        self.built = {}
+        self.pid = os.getpid()
+
+    def __getitem__(self, key):
+        if self.pid != os.getpid():
+            self.built = {}
+            self.pid = os.getpid()
+        if key not in self.built:
+            if key not in self.keys_:
+                raise KeyError(key)
+            self.built[key] = self.build(key)
+        return self.built[key]
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+
+# Versions deployed on the same chain share its endpoint pool
+rpc_pools = LazyMapping(
+    blockchains, lambda chain: EndpointPool(chain, get_rpc_urls(chain))
+)
+
+# version -> chain -> data provider address
+deployments = {}
 for chain in blockchains:
-    rpc = blockchains[chain]["rpc"]
-    oracle = blockchains[chain]["oracle"]
     for x in blockchains[chain]["contracts"]:
-        version = x["version"]
-        address = x["contract_address"]
-        provider = Provider(chain, rpc, oracle, address)
-        if version not in providers:
-            providers[version] = {}
+        deployments.setdefault(x["version"], {})[chain] = x["contract_address"]
+
+
+def build_provider(version, chain):
+    oracle = blockchains[chain]["oracle"]
+    return Provider(chain, rpc_pools[chain], oracle, deployments[version][chain])
+
+
+providers = {
+    version: LazyMapping(
+        chains, lambda chain, version=version: build_provider(version, chain)
+    )
+    for version, chains in deployments.items()
+}
+
 
-        providers[version][chain] = provider
+def warm_providers():
+    # Builds every Provider up front, meant to run in each worker after fork
+    for version in providers:
+        for chain in providers[version]:
+            providers[version][chain]
@@ -2,109 +2,66 @@ query_v2 = """
 query($id: ID!) {
 	account(id: $id) {
 		deposits {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		borrows {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		repays {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		withdraws {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		liquidations {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 
 		lend_positions: positions(where: { timestampClosed: null, side: LENDER }) {
 			market {
-				name
-				inputToken {
-					name
-					symbol
-					decimals
-				}
-				inputTokenPriceUSD
-				rates {
-					rate
-					side
-					type
-				}
+				id
 			}
 			balance
 			isCollateral
 		}
 		borrow_positions: positions(where: { timestampClosed: null, side: BORROWER }) {
 			market {
-				name
-				inputToken {
-                    id
-					name
-					symbol
-					decimals
-				}
-				inputTokenPriceUSD
-				rates {
-					rate
-					side
-					type
-				}
+				id
 			}
 			balance
 		}
@@ -117,108 +74,66 @@ query_v3 = """
 query($id: ID!) {
 	account(id: $id) {
 		deposits {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		borrows {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		repays {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		withdraws {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 		liquidations {
+			id
 			hash
 			timestamp
-			asset {
-				name
-				symbol
-				decimals
-			}
 			amount
 			amountUSD
 			market {
-				name
+				id
 			}
 		}
 
 		lend_positions: positions(where: { timestampClosed: null, side: LENDER }) {
 			market {
-				name
-				inputToken {
-					name
-					symbol
-					decimals
-				}
-				inputTokenPriceUSD
-				rates {
-					rate
-					side
-					type
-				}
+				id
 			}
 			balance
 			isCollateral
 		}
 		borrow_positions: openPositions(where: { side: BORROWER }) {
 			market {
-				name
-				inputToken {
-					name
-					symbol
-					decimals
-				}
-				inputTokenPriceUSD
-				rates {
-					rate
-					side
-					type
-				}
+				id
 			}
 			balance
 			_variableDebtBalance
@@ -230,29 +145,25 @@ query($id: ID!) {
 """
 
 query_lend_revenue = """
-query($id: ID!) {
+query($id: ID!, $since: BigInt = 0) {
   account(id: $id) {
     positions(where: {side:LENDER}) {
+      id
       market {
-        name
-        inputToken {
-          id
-          symbol
-          decimals
-        }
+        id
       }
       balance
-      deposits {
+      deposits(where: {timestamp_gt: $since}) {
         timestamp
         amount
         amountUSD
       }
-      withdraws {
+      withdraws(where: {timestamp_gt: $since}) {
         timestamp
         amount
         amountUSD
       }
-      snapshots {
+      snapshots(where: {timestamp_gt: $since}) {
         timestamp
         balance
       }
@@ -261,29 +172,25 @@ query($id: ID!) {
 }"""
 
 query_borrow_cost = """
-query($id: ID!) {
+query($id: ID!, $since: BigInt = 0) {
   account(id: $id) {
     positions(where: {side:BORROWER}) {
+      id
       market {
-        name
-        inputToken {
-          id
-          symbol
-          decimals
-        }
+        id
       }
       balance
-      borrows {
+      borrows(where: {timestamp_gt: $since}) {
         timestamp
         amount
         amountUSD
       }
-      repays {
+      repays(where: {timestamp_gt: $since}) {
         timestamp
         amount
         amountUSD
       }
-      snapshots {
+      snapshots(where: {timestamp_gt: $since}) {
         timestamp
         balance
       }
@@ -291,9 +198,119 @@ query($id: ID!) {
   }
 }"""
 
+query_markets = """
+query {
+  markets(first: 1000) {
+    id
+    name
+    inputToken {
+      id
+      name
+      symbol
+      decimals
+    }
+    inputTokenPriceUSD
+    rates {
+      rate
+      side
+      type
+    }
+  }
+}"""
+
 queries = {
     "v2": query_v2,
     "v3": query_v3,
     "lend_revenue": query_lend_revenue,
     "borrow_cost": query_borrow_cost,
+    "markets": query_markets,
 }
+
+
+def selection(query):
+    # Strip the operation wrapper, leaving the `account(id: $id) {...}` field
+    body = query.strip()
+    return body[body.index("{") + 1 : body.rindex("}")].strip()
+
+
+def build_query(*names):
+    # A query's $since variable becomes ${name}_since in the combined document
+    variables = ["$id: ID!"]
+    fields = []
+    for name in names:
+        field = selection(queries[name])
+        if "$since" in field:
+            field = field.replace("$since", f"${name}_since")
+            variables.append(f"${name}_since: BigInt = 0")
+        fields.append(f"{name}: {field}")
+    return f"query({', '.join(variables)}) {{\n" + "\n".join(fields) + "\n}"
+
+
+account_queries = {
+    version: build_query(version, "lend_revenue", "borrow_cost")
+    for version in ("v2", "v3")
+}
+
+
+def inner_selection(query):
+    field = selection(query)
+    return field[field.index("{") + 1 : field.rindex("}")].strip()
+
+
+def build_bulk_query(version):
+    return f"""
+query($ids: [ID!]!, $since: BigInt = 0) {{
+  accounts(where: {{id_in: $ids}}, first: 1000) {{
+    id
+    {inner_selection(queries[version])}
+    lend_revenue_positions: {inner_selection(queries["lend_revenue"])}
+    borrow_cost_positions: {inner_selection(queries["borrow_cost"])}
+  }}
+}}"""
+
+
+bulk_queries = {version: build_bulk_query(version) for version in ("v2", "v3")}
+
+
+# Selections used when a nested list has to be paged through its top-level
+# collection instead
+event_fields = """
+      hash
+      timestamp
+      amount
+      amountUSD
+      market {
+        id
+      }"""
+
+flow_fields = """
+      timestamp
+      amount
+      amountUSD"""
+
+snapshot_fields = """
+      timestamp
+      balance"""
+
+entity_filters = {
+    "deposits": "Deposit_filter",
+    "withdraws": "Withdraw_filter",
+    "borrows": "Borrow_filter",
+    "repays": "Repay_filter",
+    "liquidates": "Liquidate_filter",
+    "positionSnapshots": "PositionSnapshot_filter",
+}
+
+
+def build_page_query(entity, fields, order_by, order_direction="asc"):
+    return f"""
+query($where: {entity_filters[entity]}!, $first: Int!) {{
+  items: {entity}(
+    where: $where
+    first: $first
+    orderBy: {order_by}
+    orderDirection: {order_direction}
+  ) {{
+      id{fields}
+  }}
+}}"""
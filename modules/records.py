@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+
+import orjson
+
+# Output rows. Slotted dataclasses take less memory than dicts in the cached
+# payloads and orjson serializes them natively
+
+
+@dataclass
+class Activity:
+    __slots__ = (
+        "id",
+        "timestamp",
+        "txhash",
+        "action",
+        "name",
+        "symbol",
+        "amount",
+        "value",
+    )
+    id: str
+    timestamp: str
+    txhash: str
+    action: str
+    name: str
+    symbol: str
+    amount: float
+    value: float
+
+
+@dataclass
+class LendPosition:
+    __slots__ = ("name", "symbol", "amount", "value", "apy", "is_collateral")
+    name: str
+    symbol: str
+    amount: float
+    value: float
+    apy: float
+    is_collateral: bool
+
+
+@dataclass
+class BorrowPosition:
+    __slots__ = ("name", "symbol", "amount", "value", "apy", "mode")
+    name: str
+    symbol: str
+    amount: float
+    value: float
+    apy: float
+    mode: str
+
+
+def dumps(value):
+    return orjson.dumps(
+        value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    )
+
+
+loads = orjson.loads
@@ -0,0 +1,186 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import numpy as np
+from web3 import AsyncHTTPProvider, Web3
+from web3.eth import AsyncEth
+
+from modules.governor import get_governor, retrying
+from modules.http import get_session
+from modules.metrics import Counter, Gauge
+
+# Requests go to the endpoint with the best score, made of its latency EWMA
+# over successful answers and how busy it is. An endpoint whose recent error
+# rate reaches RPC_BREAKER_THRESHOLD is taken out of rotation for
+# RPC_BREAKER_COOLDOWN seconds, doubled each time its trial request after a
+# cooldown fails too. A failed request moves on to the next endpoint, and
+# with RPC_HEDGE=1 a request slower than the pool's RPC_HEDGE_PERCENTILE
+# latency is also sent to the next endpoint, the first answer wins. Each
+# attempt goes through its host's governor, and a request that failed on
+# every endpoint is retried as a whole when the error allows it
+RPC_HEDGE = os.environ.get("RPC_HEDGE") == "1"
+RPC_HEDGE_PERCENTILE = float(os.environ.get("RPC_HEDGE_PERCENTILE", 95))
+RPC_HEDGE_MIN_SAMPLES = 20
+RPC_EWMA_ALPHA = 0.2
+RPC_ERROR_HALF_LIFE = float(os.environ.get("RPC_ERROR_HALF_LIFE", 30))
+RPC_IDLE_HALF_LIFE = float(os.environ.get("RPC_IDLE_HALF_LIFE", 10))
+RPC_BREAKER_THRESHOLD = float(os.environ.get("RPC_BREAKER_THRESHOLD", 0.5))
+RPC_BREAKER_COOLDOWN = float(os.environ.get("RPC_BREAKER_COOLDOWN", 30))
+RPC_BREAKER_MAX_TRIPS = 5
+
+endpoint_latency = Gauge(
+    "rpc_endpoint_latency_seconds", "RPC endpoint latency EWMA", ("chain", "url")
+)
+endpoint_errors = Counter(
+    "rpc_endpoint_errors_total", "RPC endpoint failed requests", ("chain", "url")
+)
+breaker_trips = Counter(
+    "rpc_breaker_trips_total",
+    "RPC endpoints taken out of rotation",
+    ("chain", "url"),
+)
+hedged_requests = Counter(
+    "rpc_hedged_requests_total", "RPC requests sent to a second endpoint", ("chain",)
+)
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        provider = AsyncHTTPProvider(url, request_kwargs={"raise_for_status": True})
+        self.w3 = Web3(provider, modules={"eth": (AsyncEth,)}, middlewares=[])
+        self.connected = False
+        self.governor = get_governor(url)
+        self.latency = None  # EWMA seconds, None until the first answer
+        self.error_rate = 0
+        self.last_error = 0
+        self.last_used = 0
+        self.in_flight = 0
+        self.open_until = 0
+        self.trips = 0  # consecutive breaker trips, reset by a success
+
+    async def eth(self):
+        # Web3 would open a session of its own, it gets the pooled one instead
+        if not self.connected:
+            await self.w3.provider.cache_async_session(get_session(self.url))
+            self.connected = True
+        return self.w3.eth
+
+    def score(self, now):
+        # Lower is better. Untried endpoints score 0 so each gets measured.
+        # The latency fades while an endpoint is left alone, so a slow one is
+        # tried again later. Open and paused endpoints go last and are only
+        # used when everything else failed
+        if now < self.open_until or self.governor.paused(now):
+            return float("inf")
+        if self.latency is None:
+            return 0
+        idle = 0.5 ** ((now - self.last_used) / RPC_IDLE_HALF_LIFE)
+        return self.latency * idle * (1 + self.in_flight)
+
+    def errors(self, now):
+        return self.error_rate * 0.5 ** ((now - self.last_error) / RPC_ERROR_HALF_LIFE)
+
+    def fail(self):
+        # Returns True when this failure takes the endpoint out of rotation
+        now = time.monotonic()
+        errors = self.errors(now)
+        self.error_rate = errors + RPC_EWMA_ALPHA * (1 - errors)
+        self.last_error = now
+        if self.trips == 0 and self.error_rate < RPC_BREAKER_THRESHOLD:
+            return False
+        cooldown = RPC_BREAKER_COOLDOWN * 2 ** min(self.trips, RPC_BREAKER_MAX_TRIPS)
+        self.open_until = now + cooldown
+        self.trips += 1
+        return True
+
+    def succeed(self, elapsed):
+        self.observe(elapsed)
+        self.error_rate *= 1 - RPC_EWMA_ALPHA
+        self.trips = 0
+
+    def observe(self, elapsed):
+        if self.latency is None:
+            self.latency = elapsed
+        self.latency += RPC_EWMA_ALPHA * (elapsed - self.latency)
+        self.last_used = time.monotonic()
+
+
+class EndpointPool:
+    def __init__(self, chain, urls):
+        self.chain = chain
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.samples = deque(maxlen=200)
+
+    def ranked(self):
+        now = time.monotonic()
+        return sorted(self.endpoints, key=lambda endpoint: endpoint.score(now))
+
+    def hedge_delay(self):
+        if not RPC_HEDGE or len(self.samples) < RPC_HEDGE_MIN_SAMPLES:
+            return None
+        return np.percentile(self.samples, RPC_HEDGE_PERCENTILE)
+
+    async def attempt(self, endpoint, request):
+        endpoint.in_flight += 1
+        start = time.monotonic()
+        try:
+            eth = await endpoint.eth()
+            result = await endpoint.governor.run(lambda: request(eth))
+        except asyncio.CancelledError:
+            # A hedge that lost took at least this long
+            endpoint.observe(time.monotonic() - start)
+            raise
+        except Exception:
+            # A fast failure says nothing about how fast the endpoint answers
+            endpoint_errors.inc(self.chain, endpoint.url)
+            if endpoint.fail():
+                breaker_trips.inc(self.chain, endpoint.url)
+            raise
+        finally:
+            endpoint.in_flight -= 1
+        elapsed = time.monotonic() - start
+        endpoint.succeed(elapsed)
+        endpoint_latency.set(self.chain, endpoint.url, value=endpoint.latency)
+        self.samples.append(elapsed)
+        return result
+
+    async def call(self, tx, block_identifier="latest"):
+        return await self.request(lambda eth: eth.call(tx, block_identifier))
+
+    async def block_number(self):
+        return await self.request(lambda eth: eth.get_block_number())
+
+    async def request(self, request):
+        # request takes an AsyncEth and returns the awaitable to run on it
+        return await retrying(lambda: self.request_once(request), self.chain)
+
+    async def request_once(self, request):
+        candidates = self.ranked()
+        delay = self.hedge_delay()
+        pending = {asyncio.ensure_future(self.attempt(candidates.pop(0), request))}
+        hedged = False
+        error = None
+        try:
+            while len(pending) > 0:
+                timeout = None if hedged or len(candidates) == 0 else delay
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if len(done) == 0:
+                    hedged = True
+                    hedged_requests.inc(self.chain)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                # Fail over, or hedge when the wait above timed out
+                if len(candidates) > 0 and (len(done) == 0 or len(pending) == 0):
+                    endpoint = candidates.pop(0)
+                    pending.add(asyncio.ensure_future(self.attempt(endpoint, request)))
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
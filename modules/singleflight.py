@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+from modules.deadline import Deadline, DeadlineExceeded, deadline_var
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one in-flight task and its
+    # result (or exception). The task is shielded so one caller giving up
+    # does not cancel it for the others, each caller only bounds its own
+    # wait. The task runs until the latest deadline among its callers and is
+    # cancelled after that, or with `timeout` under that fixed budget
+    # whatever its callers' deadlines
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.calls = {}  # key -> (task, Deadline)
+
+    async def do(self, key, fn, *args):
+        caller = deadline_var.get()
+        call = self.calls.get(key)
+        if call is None:
+            if self.timeout is not None:
+                deadline = Deadline(time.monotonic() + self.timeout)
+            else:
+                deadline = Deadline(None if caller is None else caller.at)
+            task = asyncio.ensure_future(self.run(deadline, fn, *args))
+            call = (task, deadline)
+            self.calls[key] = call
+            task.add_done_callback(lambda t: self.forget(key, t))
+        elif self.timeout is None:
+            call[1].extend(caller)
+        return await asyncio.shield(call[0])
+
+    async def run(self, deadline, fn, *args):
+        deadline_var.set(deadline)
+        task = asyncio.ensure_future(fn(*args))
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=deadline.remaining())
+                if not task.done() and deadline.remaining() == 0:
+                    raise DeadlineExceeded()
+            return task.result()
+        finally:
+            task.cancel()
+
+    def forget(self, key, task):
+        call = self.calls.get(key)
+        if call is not None and call[0] is task:
+            del self.calls[key]
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.metrics import Counter
+
+# Per-position PnL checkpoints, so a refresh only folds in events newer than
+# the last one processed. Each worker process opens the connection on first
+# use, and every query runs on that worker's one store thread, off the event
+# loop. Workers share the file, so a write can find it locked. A read that
+# fails gives no checkpoints and a write that fails is skipped, both only
+# cost a full recompute
+path = os.environ.get("PNL_STORE_PATH", "pnl.sqlite3")
+PNL_STORE_BUSY_TIMEOUT = float(os.environ.get("PNL_STORE_BUSY_TIMEOUT", 2))
+connection = None
+executor = None
+
+store_errors = Counter(
+    "pnl_store_errors_total", "Failed PnL checkpoint queries", ("operation",)
+)
+
+schema = """
+CREATE TABLE IF NOT EXISTS pnl_checkpoints (
+    market TEXT NOT NULL,
+    version TEXT NOT NULL,
+    address TEXT NOT NULL,
+    asset TEXT NOT NULL,
+    side TEXT NOT NULL,
+    position TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    prev_balance REAL NOT NULL,
+    realized REAL NOT NULL,
+    events INTEGER NOT NULL,
+    snapshots INTEGER NOT NULL,
+    PRIMARY KEY (market, version, address, side, position)
+)
+"""
+
+
+async def in_store_thread(fn, *args):
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=1)
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def get_connection():
+    global connection
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=PNL_STORE_BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(schema)
+    return connection
+
+
+def load_checkpoints(market, version, address, side):
+    try:
+        rows = (
+            get_connection()
+            .execute(
+                """
+            SELECT position, asset, timestamp, prev_balance, realized, events, snapshots
+            FROM pnl_checkpoints
+            WHERE market = ? AND version = ? AND address = ? AND side = ?
+            """,
+                (market, version, address.lower(), side),
+            )
+            .fetchall()
+        )
+    except sqlite3.Error:
+        store_errors.inc("load")
+        return {}
+    return {
+        row[0]: {
+            "asset": row[1],
+            "timestamp": row[2],
+            "prev_balance": row[3],
+            "realized": row[4],
+            "events": row[5],
+            "snapshots": row[6],
+        }
+        for row in rows
+    }
+
+
+def save_checkpoints(market, version, address, side, checkpoints):
+    rows = [
+        (
+            market,
+            version,
+            address.lower(),
+            cp["asset"],
+            side,
+            position,
+            cp["timestamp"],
+            cp["prev_balance"],
+            cp["realized"],
+            cp["events"],
+            cp["snapshots"],
+        )
+        for position, cp in checkpoints.items()
+    ]
+    if len(rows) == 0:
+        return
+    try:
+        conn = get_connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO pnl_checkpoints VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+    except sqlite3.Error:
+        store_errors.inc("save")
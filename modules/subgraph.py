@@ -0,0 +1,195 @@
+import asyncio
+import os
+
+import orjson
+
+from modules.deadline import bounded
+from modules.governor import call
+from modules.http import get_session
+from modules.metrics import subgraph_requests
+from modules.query import build_page_query
+from modules.records import dumps, loads
+from modules.singleflight import SingleFlight
+from modules.timing import span
+
+# Largest `first` the subgraph accepts for a top-level collection
+PAGE_SIZE = 1000
+
+# {version} and {market} are filled in per request
+SUBGRAPH_URL = os.environ.get(
+    "SUBGRAPH_URL",
+    "https://api.thegraph.com/subgraphs/name/messari/aave-{version}-{market}",
+)
+
+subgraph_flight = SingleFlight()
+
+
+class SubgraphError(Exception):
+    pass
+
+
+def subgraph_url(version, market):
+    return SUBGRAPH_URL.format(version=version, market=market)
+
+
+async def request_subgraph(query, variables, version, market, name="query"):
+    # name only labels the query in the metrics
+    key = (query, orjson.dumps(variables, option=orjson.OPT_SORT_KEYS), version, market)
+    with span(f"subgraph.{name}"):
+        return await bounded(
+            subgraph_flight.do(
+                key, observe_query, query, variables, version, market, name
+            )
+        )
+
+
+async def observe_query(query, variables, version, market, name):
+    with subgraph_requests.track(version, market, name):
+        data = await post_query(query, variables, version, market)
+    if "errors" in data:
+        subgraph_requests.errors.inc(version, market, name)
+    return data
+
+
+async def post_query(query, variables, version, market):
+    url = subgraph_url(version, market)
+    data = dumps({"query": query, "variables": variables})
+
+    async def post():
+        response = await get_session(url).post(
+            url,
+            data=data,
+            headers={"Content-Type": "application/json"},
+            raise_for_status=True,
+        )
+        async with response:
+            return loads(await response.read())
+
+    return await call(url, post)
+
+
+async def fetch_page(
+    entity, fields, where, order_by, descending, first, version, market
+):
+    query = build_page_query(entity, fields, order_by, "desc" if descending else "asc")
+    variables = {"where": where, "first": first}
+    data = await request_subgraph(query, variables, version, market, entity)
+    if "errors" in data:
+        raise SubgraphError(data["errors"])
+    return data["data"]["items"]
+
+
+def order_key(item):
+    return int(item["timestamp"]), item["id"]
+
+
+async def paginate(
+    entity, fields, where, version, market, descending=False, first=PAGE_SIZE
+):
+    # Yields pages in (timestamp, id) order. A full page can stop partway
+    # through a timestamp, so that timestamp is walked by id before the
+    # timestamp cursor moves past it
+    after = "_lt" if descending else "_gt"
+    timestamp = None
+    while True:
+        page_where = (
+            where if timestamp is None else {**where, "timestamp" + after: timestamp}
+        )
+        page = await fetch_page(
+            entity, fields, page_where, "timestamp", descending, first, version, market
+        )
+        page.sort(key=order_key, reverse=descending)
+        if len(page) < first:
+            if len(page) > 0:
+                yield page
+            return
+
+        timestamp = page[-1]["timestamp"]
+        head = [item for item in page if item["timestamp"] != timestamp]
+        if len(head) > 0:
+            yield head
+
+        tie_where = {**where, "timestamp": timestamp}
+        async for tie in paginate_ties(
+            entity, fields, tie_where, version, market, descending, first
+        ):
+            yield tie
+
+
+async def paginate_ties(
+    entity,
+    fields,
+    where,
+    version,
+    market,
+    descending=False,
+    first=PAGE_SIZE,
+    last_id=None,
+):
+    # Pages through items sharing one timestamp by id, starting after last_id
+    after = "_lt" if descending else "_gt"
+    while True:
+        tie_where = where if last_id is None else {**where, "id" + after: last_id}
+        tie = await fetch_page(
+            entity, fields, tie_where, "id", descending, first, version, market
+        )
+        if len(tie) > 0:
+            yield tie
+        if len(tie) < first:
+            return
+        last_id = tie[-1]["id"]
+
+
+async def paginate_after(
+    entity, fields, where, cursor, version, market, descending=False, first=PAGE_SIZE
+):
+    # Like paginate, but resumes strictly after a (timestamp, id) cursor
+    if cursor is not None:
+        timestamp, last_id = cursor
+        tie_where = {**where, "timestamp": timestamp}
+        async for tie in paginate_ties(
+            entity, fields, tie_where, version, market, descending, first, last_id
+        ):
+            yield tie
+        after = "_lt" if descending else "_gt"
+        where = {**where, "timestamp" + after: timestamp}
+    async for page in paginate(
+        entity, fields, where, version, market, descending, first
+    ):
+        yield page
+
+
+def prefetch(pages, maxsize=2):
+    # Fetches ahead of the consumer into a bounded queue, so at most
+    # `maxsize` pages per list are held while the consumer catches up
+    queue = asyncio.Queue(maxsize)
+
+    async def fill():
+        try:
+            async for page in pages:
+                await queue.put(page)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    async def drain():
+        task = asyncio.ensure_future(fill())
+        try:
+            while True:
+                page = await queue.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            task.cancel()
+
+    return drain()
+
+
+async def fetch_all(entity, fields, where, version, market):
+    items = []
+    async for page in prefetch(paginate(entity, fields, where, version, market)):
+        items.extend(page)
+    return items
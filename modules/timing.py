@@ -0,0 +1,130 @@
+import cProfile
+import io
+import pstats
+import time
+from contextvars import ContextVar
+
+# Per-request span tree for the Server-Timing header and ?profile=1. Spans
+# are only recorded inside a request that started a trace, elsewhere span()
+# costs one context variable lookup
+
+trace_var = ContextVar("trace", default=None)
+parent_var = ContextVar("span_parent", default=None)
+profiling = False
+
+
+class Span:
+    __slots__ = ("name", "start", "duration", "children")
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.children = []
+
+
+class span:
+    __slots__ = ("name", "span", "token")
+
+    def __init__(self, name):
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        trace = trace_var.get()
+        if trace is None:
+            return self
+        self.span = Span(self.name, time.perf_counter())
+        parent = parent_var.get()
+        (trace.spans if parent is None else parent.children).append(self.span)
+        self.token = parent_var.set(self.span)
+        return self
+
+    def __exit__(self, *exc):
+        if self.span is not None:
+            self.span.duration = time.perf_counter() - self.span.start
+            parent_var.reset(self.token)
+
+
+class Trace:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def walk(self, spans=None):
+        for s in self.spans if spans is None else spans:
+            yield s
+            yield from self.walk(s.children)
+
+    def header(self):
+        # Spans with the same name are summed, desc holds the count
+        totals = {}
+        for s in self.walk():
+            if s.duration is not None:
+                duration, count = totals.get(s.name, (0, 0))
+                totals[s.name] = (duration + s.duration, count + 1)
+        entries = [
+            f'{name};dur={duration * 1000:.1f};desc="x{count}"'
+            for name, (duration, count) in totals.items()
+        ]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def tree(self, spans=None):
+        return [
+            {
+                "name": s.name,
+                "start_ms": (s.start - self.start) * 1000,
+                "duration_ms": None if s.duration is None else s.duration * 1000,
+                "children": self.tree(s.children),
+            }
+            for s in (self.spans if spans is None else spans)
+        ]
+
+
+async def timed(name, awaitable):
+    with span(name):
+        return await awaitable
+
+
+def start_trace():
+    trace = Trace()
+    trace_var.set(trace)
+    parent_var.set(None)
+    return trace
+
+
+def profile_summary(profiler, limit=25):
+    # The profiler sees the whole event loop thread, so concurrent requests
+    # show up in it too
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append(
+            {
+                "function": f"{filename}:{line}({name})",
+                "calls": calls,
+                "tottime_ms": tottime * 1000,
+                "cumtime_ms": cumtime * 1000,
+            }
+        )
+    rows.sort(key=lambda row: row["cumtime_ms"], reverse=True)
+    return rows[:limit]
+
+
+def start_profiler():
+    # Only one profiler can run at a time, None when another request has it
+    global profiling
+    if profiling:
+        return None
+    profiling = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler):
+    global profiling
+    if profiler is not None:
+        profiler.disable()
+        profiling = False
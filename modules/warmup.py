@@ -0,0 +1,100 @@
+import asyncio
+import os
+import random
+import time
+
+from modules.account import refresh_account
+
+# Keeps the account cache warm for a watchlist, given as comma-separated
+# version:market:address entries in WARMUP_WATCHLIST. Oracle prices are not
+# warmed, they are read at the pinned block and would only serve requests
+# made within the same block. Every worker runs its own scheduler since the
+# caches are per process
+WARMUP_WATCHLIST = os.environ.get("WARMUP_WATCHLIST", "")
+WARMUP_ACCOUNT_INTERVAL = float(os.environ.get("WARMUP_ACCOUNT_INTERVAL", 8))
+WARMUP_JITTER = float(os.environ.get("WARMUP_JITTER", 0.2))
+WARMUP_CONCURRENCY = int(os.environ.get("WARMUP_CONCURRENCY", 4))
+WARMUP_MAX_BACKOFF = float(os.environ.get("WARMUP_MAX_BACKOFF", 300))
+TICK = 1
+
+task = None
+# The loop only keeps weak references to tasks, so running jobs are held here
+job_tasks = set()
+
+
+def parse_watchlist(watchlist):
+    entries = []
+    for entry in watchlist.split(","):
+        if entry.strip() == "":
+            continue
+        version, market, address = entry.strip().split(":")
+        entries.append((version, market, address))
+    return entries
+
+
+def get_jobs():
+    # Each job is (key, interval, coroutine function, args)
+    return [
+        (
+            ("account", version, market, address),
+            WARMUP_ACCOUNT_INTERVAL,
+            refresh_account,
+            (address, version, market),
+        )
+        for version, market, address in parse_watchlist(WARMUP_WATCHLIST)
+    ]
+
+
+def jittered(seconds):
+    return seconds * random.uniform(1 - WARMUP_JITTER, 1 + WARMUP_JITTER)
+
+
+async def run(jobs):
+    semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+    # Spread the first runs over one interval instead of firing all at boot
+    now = time.monotonic()
+    next_run = {key: now + random.uniform(0, interval) for key, interval, *_ in jobs}
+    failures = {key: 0 for key, *_ in jobs}
+    running = set()
+
+    async def run_job(key, interval, fn, args):
+        try:
+            async with semaphore:
+                await fn(*args)
+            failures[key] = 0
+            next_run[key] = time.monotonic() + jittered(interval)
+        except Exception:
+            # Back off exponentially while the upstream keeps failing
+            failures[key] += 1
+            delay = min(interval * 2 ** failures[key], WARMUP_MAX_BACKOFF)
+            next_run[key] = time.monotonic() + jittered(delay)
+        finally:
+            running.discard(key)
+
+    while True:
+        now = time.monotonic()
+        for key, interval, fn, args in jobs:
+            if key not in running and next_run[key] <= now:
+                running.add(key)
+                job = asyncio.create_task(run_job(key, interval, fn, args))
+                job_tasks.add(job)
+                job.add_done_callback(job_tasks.discard)
+        await asyncio.sleep(TICK)
+
+
+def start():
+    global task
+    jobs = get_jobs()
+    if len(jobs) > 0 and task is None:
+        task = asyncio.create_task(run(jobs))
+
+
+async def stop():
+    global task
+    tasks = list(job_tasks)
+    if task is not None:
+        tasks.append(task)
+        task = None
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,42 @@
+import time
+
+from modules.cache import ResponseCache
+from modules.records import dumps
+
+
+def test_evicts_least_recently_used_by_size():
+    size = len(dumps({"v": "x" * 10}))
+    cache = ResponseCache(size * 2, 60, 60)
+    cache.set("a", {"v": "x" * 10})
+    cache.set("b", {"v": "x" * 10})
+    cache.get("a")
+    cache.set("c", {"v": "x" * 10})
+    assert cache.get("b") == (None, None)
+    assert cache.get("a")[1] == "fresh"
+    assert cache.get("c")[1] == "fresh"
+    assert cache.nbytes == size * 2
+
+
+def test_replacing_a_key_updates_its_size():
+    cache = ResponseCache(1000, 60, 60)
+    cache.set("a", {"v": "x" * 100})
+    cache.set("a", {"v": ""})
+    assert cache.nbytes == len(dumps({"v": ""}))
+
+
+def test_skips_payloads_larger_than_the_cache():
+    cache = ResponseCache(10, 60, 60)
+    cache.set("a", {"v": "x" * 100})
+    assert cache.get("a") == (None, None)
+    assert cache.nbytes == 0
+
+
+def test_fresh_then_stale_then_gone():
+    cache = ResponseCache(1000, 0.05, 0.05)
+    cache.set("a", {"v": 1})
+    assert cache.get("a") == ({"v": 1}, "fresh")
+    time.sleep(0.06)
+    assert cache.get("a") == ({"v": 1}, "stale")
+    time.sleep(0.05)
+    assert cache.get("a") == (None, None)
+    assert cache.nbytes == 0
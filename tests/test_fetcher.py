@@ -0,0 +1,49 @@
+import asyncio
+import random
+
+from modules.fetcher import decode_cursor, merge_descending
+
+
+async def stream(items):
+    for item in items:
+        await asyncio.sleep(0)
+        yield item
+
+
+async def merged(streams):
+    return [item async for item in merge_descending(streams, lambda x: x)]
+
+
+def test_merge_descending():
+    rng = random.Random(0)
+    lists = [sorted(rng.sample(range(100), 10), reverse=True) for _ in range(4)]
+    lists.append([])
+    result = asyncio.run(merged([stream(items) for items in lists]))
+    assert result == sorted(sum(lists, []), reverse=True)
+
+
+def test_merge_descending_stops_early():
+    pulled = []
+
+    async def counting(items):
+        for item in items:
+            pulled.append(item)
+            yield item
+
+    async def first_two():
+        streams = [counting([9, 5, 1]), counting([8, 7, 6])]
+        result = []
+        async for item in merge_descending(streams, lambda x: x):
+            result.append(item)
+            if len(result) == 2:
+                return result
+
+    assert asyncio.run(first_two()) == [9, 8]
+    # One item ahead per stream, 7 is never pulled
+    assert sorted(pulled) == [5, 8, 9]
+
+
+def test_decode_cursor():
+    assert decode_cursor("1600000000:0xab-1") == ("1600000000", "0xab-1")
+    for cursor in ["", "abc", "12", "12:", ":0xab", "-1:0xab", "1.5:0xab", "١:0xab"]:
+        assert decode_cursor(cursor) is None
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+
+from modules import governor
+from modules.deadline import set_deadline
+from modules.governor import Governor, UpstreamPaused, parse_retry_after, retry_after
+
+
+def response_error(status, headers=None):
+    return aiohttp.ClientResponseError(None, (), status=status, headers=headers)
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (response_error(429, {"Retry-After": "3"}), 3),
+        (response_error(503), 0),
+        (response_error(400), None),
+        (response_error(404), None),
+        (aiohttp.ServerDisconnectedError(), 0),
+        (asyncio.TimeoutError(), 0),
+        (ValueError({"code": -32005, "message": "limit exceeded"}), 0),
+        (ValueError({"code": 3, "message": "execution reverted"}), None),
+        (ValueError("not json"), None),
+        (KeyError("x"), None),
+    ],
+)
+def test_retry_after_classification(error, expected):
+    assert retry_after(error) == expected
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) == 0
+    assert parse_retry_after("-5") == 0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("garbage") == 0
+
+
+def test_pause_is_capped():
+    g = Governor("host", 1, 10, 10)
+    g.pause(3600)
+    assert g.paused_until - time.monotonic() <= governor.UPSTREAM_MAX_BACKOFF
+
+
+def test_take_fails_fast_when_paused_past_the_deadline():
+    async def main():
+        g = Governor("host", 1, 10, 10)
+        g.pause(5)
+        set_deadline(0.1)
+        with pytest.raises(UpstreamPaused):
+            await g.take()
+
+    asyncio.run(main())
+
+
+def test_retrying_retries_retryable_errors_only():
+    async def main(error):
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            if len(calls) < 3:
+                raise error
+            return "ok"
+
+        try:
+            return await governor.retrying(fn, "test", retries=3), len(calls)
+        except Exception:
+            return None, len(calls)
+
+    saved, governor.UPSTREAM_BACKOFF = governor.UPSTREAM_BACKOFF, 0
+    try:
+        assert asyncio.run(main(response_error(502))) == ("ok", 3)
+        assert asyncio.run(main(response_error(400))) == (None, 1)
+    finally:
+        governor.UPSTREAM_BACKOFF = saved
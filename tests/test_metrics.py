@@ -0,0 +1,38 @@
+from modules.metrics import Counter, Gauge, Histogram, format_labels, registry
+
+
+def lines(metric):
+    registry.remove(metric)
+    return metric.render()
+
+
+def test_histogram_buckets_are_cumulative_and_inf_equals_count():
+    histogram = Histogram("test_seconds", "Test", ("path",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe("/a", value=value)
+    assert lines(histogram) == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{path="/a",le="0.1"} 1',
+        'test_seconds_bucket{path="/a",le="1"} 2',
+        'test_seconds_bucket{path="/a",le="+Inf"} 3',
+        'test_seconds_count{path="/a"} 3',
+        'test_seconds_sum{path="/a"} 5.55',
+    ]
+
+
+def test_counter_and_gauge():
+    counter = Counter("test_total", "Test", ("kind",))
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    assert lines(counter)[-1] == 'test_total{kind="a"} 3'
+
+    gauge = Gauge("test_in_flight", "Test")
+    gauge.inc()
+    gauge.dec()
+    gauge.inc()
+    assert lines(gauge)[-1] == "test_in_flight 1"
+
+
+def test_label_values_are_escaped():
+    assert format_labels(("a",), ('x"y\\z\n',)) == '{a="x\\"y\\\\z\\n"}'
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from modules.deadline import DeadlineExceeded, bounded, remaining, set_deadline
+from modules.singleflight import SingleFlight
+
+
+def test_shared_task_runs_until_the_latest_deadline():
+    async def main():
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.2)
+            return "done"
+
+        async def caller(seconds):
+            set_deadline(seconds)
+            return await bounded(flight.do("key", work))
+
+        short = asyncio.ensure_future(caller(0.05))
+        await asyncio.sleep(0)
+        long = asyncio.ensure_future(caller(1))
+        with pytest.raises(DeadlineExceeded):
+            await short
+        assert await long == "done"
+
+    asyncio.run(main())
+
+
+def test_shared_task_is_cancelled_after_every_deadline():
+    async def main():
+        flight = SingleFlight()
+        cancelled = []
+
+        async def work():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        set_deadline(0.05)
+        with pytest.raises(DeadlineExceeded):
+            await flight.do("key", work)
+        await asyncio.sleep(0)
+        assert cancelled == [1]
+        assert flight.calls == {}
+
+    asyncio.run(main())
+
+
+def test_timeout_ignores_the_callers_deadline():
+    async def main():
+        flight = SingleFlight(1)
+
+        async def work():
+            return remaining()
+
+        set_deadline(0.05)
+        assert await flight.do("key", work) > 0.5
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import asyncio
+import random
+
+import pytest
+
+from modules import subgraph
+
+
+def make_items(rng, count):
+    # Few distinct timestamps, so most pages end partway through one
+    return [
+        {"id": f"0x{i:04x}", "timestamp": str(rng.randint(1, 5))} for i in range(count)
+    ]
+
+
+def matches(item, where):
+    for field, value in where.items():
+        name, _, op = field.partition("_")
+        key = int if name == "timestamp" else str
+        left, right = key(item[name]), key(value)
+        if op == "" and left != right:
+            return False
+        if op == "gt" and not left > right:
+            return False
+        if op == "lt" and not left < right:
+            return False
+    return True
+
+
+def fake_fetch_page(items, rng):
+    # Orders by order_by only, like the subgraph, so ties come back shuffled
+    async def fetch_page(
+        entity, fields, where, order_by, descending, first, version, market
+    ):
+        page = [item for item in items if matches(item, where)]
+        rng.shuffle(page)
+        key = (lambda i: int(i["timestamp"])) if order_by == "timestamp" else None
+        page.sort(key=key or (lambda i: i["id"]), reverse=descending)
+        return page[:first]
+
+    return fetch_page
+
+
+async def collect(pages):
+    return [item async for page in pages for item in page]
+
+
+def expected(items, descending):
+    return sorted(items, key=subgraph.order_key, reverse=descending)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("descending", [False, True])
+def test_paginate_walks_ties(monkeypatch, seed, descending):
+    rng = random.Random(seed)
+    items = make_items(rng, rng.randint(0, 40))
+    monkeypatch.setattr(subgraph, "fetch_page", fake_fetch_page(items, rng))
+    pages = subgraph.paginate("items", "", {}, "v2", "ethereum", descending, first=3)
+    assert asyncio.run(collect(pages)) == expected(items, descending)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("descending", [False, True])
+def test_paginate_after_resumes_after_the_cursor(monkeypatch, seed, descending):
+    rng = random.Random(seed)
+    items = make_items(rng, rng.randint(1, 40))
+    monkeypatch.setattr(subgraph, "fetch_page", fake_fetch_page(items, rng))
+    ordered = expected(items, descending)
+    index = rng.randrange(len(ordered))
+    cursor = (ordered[index]["timestamp"], ordered[index]["id"])
+    pages = subgraph.paginate_after(
+        "items", "", {}, cursor, "v2", "ethereum", descending, first=3
+    )
+    assert asyncio.run(collect(pages)) == ordered[index + 1 :]